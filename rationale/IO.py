@@ -11,15 +11,40 @@ create_one_batch:
     - creates one batch
 read_annotations:
     - reads the annotated files
+convert_embeddings:
+    - converts a text embedding file into a binary store (.npy + vocab)
+create_embedding_layer:
+    - creates the embedding layer, memory-mapping the binary store if present
+create_pruned_embedding_layer:
+    - creates an embedding layer holding only the words used by the corpus
+load_compiled_annotations:
+    - loads an annotations file as memory-mapped flat token ids and labels,
+      compiling it once if needed
+PaddedBatches:
+    - padded batches that are built on demand
+BatchPrefetcher:
+    - prepares batches in a background thread while the graph runs
     
     
 """
 
 import numpy as np
+import os
 import sys
 import gzip
 import random
 import json
+import hashlib
+import itertools
+import collections
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+import Queue
+from gzip_index import load_line_index
+from atomic_io import atomic_write
 
 #####################
 # Code from Tau lei #
@@ -45,36 +70,155 @@ def random_init(size, rng=None, rng_type=None):
 
     return vals
 
+def grow_matrix(mat, n_rows):
+    '''
+    Copy of mat with room for n_rows rows, the new rows are uninitialized.
+    '''
+    grown = np.empty((n_rows,) + mat.shape[1:], dtype = mat.dtype)
+    grown[:len(mat)] = mat
+    return grown
+
 def say(s, stream=sys.stdout):
     stream.write("{}".format(s))
     stream.flush()
 
+class FlatSequences(object):
+    '''
+        Ragged list of id sequences stored as one flat int32 array of ids 
+        plus int64 offsets, sequence i is ids[offsets[i]:offsets[i+1]].
+        
+        max_len truncates every sequence without copying the ids.
+    '''
+    
+    def __init__(self, ids, offsets, max_len = None):
+        self.ids = ids
+        self.offsets = offsets
+        self.max_len = max_len
+        
+    @classmethod
+    def from_list(cls, seqs):
+        lengths = np.fromiter((len(x) for x in seqs), dtype = np.int64, 
+                              count = len(seqs))
+        offsets = np.zeros(len(seqs) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = offsets[1:])
+        if len(seqs):
+            ids = np.concatenate(seqs).astype(np.int32)
+        else:
+            ids = np.zeros(0, dtype = np.int32)
+        return cls(ids, offsets)
+        
+    def truncate(self, max_len):
+        return FlatSequences(self.ids, self.offsets, max_len)
+        
+    def lengths(self):
+        lengths = np.diff(self.offsets)
+        if self.max_len is not None:
+            lengths = np.minimum(lengths, self.max_len)
+        return lengths
+        
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i+1]
+        if self.max_len is not None:
+            end = min(end, start + self.max_len)
+        return self.ids[start:end]
+    
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+class PaddedBatches(object):
+    '''
+        Sequence of the padded batches of create_batches(lazy = True), batch
+        i is only built (one scatter from the flat ids) when it is indexed,
+        e.g. in the thread of a BatchPrefetcher.
+    '''
+    
+    def __init__(self, x, lengths, batch_idx, padding_id):
+        self.x = x
+        self.lengths = lengths
+        self.batch_idx = batch_idx
+        self.padding_id = padding_id
+    
+    def __len__(self):
+        return len(self.batch_idx)
+    
+    def __getitem__(self, i):
+        idx = self.batch_idx[i]
+        bx = np.empty((max(self.lengths[idx].max(), 1), len(idx)),
+                      dtype = np.int32)
+        bx.fill(self.padding_id)
+        fill_batch(bx, self.x, self.lengths, idx)
+        return bx
+
 # only minor changes done
-def create_batches(x, y, batch_size, padding_id, sort=True):
-    batches_x, batches_y = [ ], [ ]
+def create_batches(x, y, batch_size, padding_id, sort=True, lazy=False):
+    '''
+    Sort (optionally) and pad the sequences into batches of shape
+    (max_len, batch). All batches are views into one preallocated int32
+    buffer, each filled with a single vectorized scatter from the flat 
+    ids/offsets layout. x may be a FlatSequences or a list of id arrays.
+    With lazy the padded batches are a PaddedBatches, built when indexed.
+    Empty sequences are kept as columns of padding, so the batches stay
+    aligned with the input, and empty input gives no batches.
+    '''
+    if not isinstance(x, FlatSequences):
+        x = FlatSequences.from_list(x)
     N = len(x)
+    if N == 0:
+        return [ ], [ ]
+    y = np.vstack(y) if isinstance(y, list) else y
     M = (N-1)/batch_size + 1
+    
+    lengths = x.lengths()
     if sort:
-        perm = range(N)
-        perm = sorted(perm, key=lambda i: len(x[i]))
-        x = [ x[i] for i in perm ]
-        y = [ y[i] for i in perm ]
-    for i in xrange(M):
-        bx, by = create_one_batch(
-                    x[i*batch_size:(i+1)*batch_size],
-                    y[i*batch_size:(i+1)*batch_size],
-                    padding_id
-                )
-        batches_x.append(bx)
-        batches_y.append(by)
+        # stable sort, same order as sorting by len(x[i])
+        perm = np.argsort(lengths, kind = "mergesort")
+    else:
+        perm = np.arange(N)
+    
+    batch_idx = [ perm[i*batch_size:(i+1)*batch_size] for i in xrange(M) ]
     if sort:
         random.seed(5817)
         perm2 = range(M)
         random.shuffle(perm2)
-        batches_x = [ batches_x[i] for i in perm2 ]
-        batches_y = [ batches_y[i] for i in perm2 ]
+        batch_idx = [ batch_idx[i] for i in perm2 ]
+    
+    if lazy:
+        return PaddedBatches(x, lengths, batch_idx, padding_id), \
+               [ y[idx] for idx in batch_idx ]
+    
+    # one buffer for all batches
+    # at least one row, also for a batch of empty sequences
+    batch_len = [ max(lengths[idx].max(), 1) for idx in batch_idx ]
+    sizes = [ l * len(idx) for l, idx in zip(batch_len, batch_idx) ]
+    pool = np.empty(sum(sizes), dtype = np.int32)
+    pool.fill(padding_id)
+    
+    batches_x, batches_y = [ ], [ ]
+    offset = 0
+    for idx, max_len, size in zip(batch_idx, batch_len, sizes):
+        bx = pool[offset:offset+size].reshape(max_len, len(idx))
+        fill_batch(bx, x, lengths, idx)
+        batches_x.append(bx)
+        batches_y.append(y[idx])
+        offset += size
+    
     return batches_x, batches_y
 
+def fill_batch(bx, x, lengths, idx):
+    '''
+    Scatter the sequences idx of x into the padded batch bx, sequences are
+    left padded as in create_one_batch.
+    '''
+    lens = lengths[idx]
+    col = np.repeat(np.arange(len(idx)), lens)
+    within = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    src = np.repeat(x.offsets[idx], lens) + within
+    bx[bx.shape[0] - lens[col] + within, col] = x.ids[src]
+
 # code from Tao Lei
 def create_one_batch(lstx, lsty, padding_id):
     max_len = max(len(x) for x in lstx)
@@ -84,17 +228,47 @@ def create_one_batch(lstx, lsty, padding_id):
     by = np.vstack(lsty)
     return bx, by
 
-def read_annotations(path):
+def parse_annotation_lines(lines):
     data_x, data_y = [ ], [ ]
-    fopen = gzip.open if path.endswith(".gz") else open
-    with fopen(path) as fin:
-        for line in fin:
-            y, sep, x = line.partition("\t")
-            x, y = x.split(), y.split()
-            if len(x) == 0: continue
-            y = np.asarray([ float(v) for v in y ])
-            data_x.append(x)
-            data_y.append(y)
+    for line in lines:
+        y, sep, x = line.partition("\t")
+        x, y = x.split(), y.split()
+        if len(x) == 0: continue
+        y = np.asarray([ float(v) for v in y ])
+        data_x.append(x)
+        data_y.append(y)
+    return data_x, data_y
+
+def _annotation_chunk_worker(task):
+    idx, lines, tmp_dir = task
+    data_x, data_y = parse_annotation_lines(task_lines(lines))
+    return save_chunk_arrays(tmp_dir, idx, {
+            "tokens": np.array([ w for x in data_x for w in x ], dtype = np.string_),
+            "lengths": np.array([ len(x) for x in data_x ], dtype = np.int64),
+            "labels": np.concatenate(data_y) if data_y else np.zeros(0),
+            "label_lengths": np.array([ len(y) for y in data_y ], dtype = np.int64)
+        })
+
+def read_annotations(path, workers = 1, line_range = None):
+    '''
+    Reads an annotations file, optionally only the lines [a, b) given by 
+    line_range which are read through the random-access index of the file.
+    '''
+    if workers > 1 and line_range is None:
+        data_x, data_y = [ ], [ ]
+        for paths in parallel_parse(path, _annotation_chunk_worker, workers):
+            arrays = load_chunk_arrays(paths)
+            if not len(arrays["lengths"]):
+                # only blank lines
+                continue
+            tokens = arrays["tokens"].tolist()
+            offsets = np.concatenate([[0], np.cumsum(arrays["lengths"])])
+            data_x.extend(tokens[offsets[i]:offsets[i+1]] 
+                            for i in xrange(len(offsets)-1))
+            data_y.extend(np.split(arrays["labels"], 
+                                   np.cumsum(arrays["label_lengths"])[:-1]))
+    else:
+        data_x, data_y = parse_annotation_lines(iter_file_lines(path, line_range))
     
     print "{} examples loaded from {}\n".format(
             len(data_x), path
@@ -103,18 +277,174 @@ def read_annotations(path):
         max(len(x) for x in data_x)
     )
     return data_x, data_y
+
+def file_hash(path):
+    '''
+    Hash of the size and modification time of a file, cheap to check on
+    every startup; the file itself is not read.
+    '''
+    stat = os.stat(path)
+    return hashlib.md5("{}:{!r}".format(stat.st_size, stat.st_mtime)).hexdigest()
+
+def vocab_hash(embedding_layer):
+    return hashlib.md5("\n".join(embedding_layer.lst_words)).hexdigest()
+
+def compiled_annotations_paths(path, embedding_layer):
+    '''
+    Paths of the compiled (tokens, offsets, labels) arrays of an annotations
+    file, keyed by the size and mtime of the source file and the hash of the
+    vocab.
+    '''
+    base = path[:-len(".gz")] if path.endswith(".gz") else path
+    key = file_hash(path)[:12] + vocab_hash(embedding_layer)[:12]
+    return tuple("{}.{}.{}.npy".format(base, key, name) 
+                    for name in ("tokens", "offsets", "labels"))
+
+def compile_annotations(path, embedding_layer, workers = 1):
+    '''
+    Turn an annotations file into a flat int32 token array, int64 offsets
+    and a float32 label matrix stored as .npy files.
+    '''
+    data_x, data_y = read_annotations(path, workers)
+    flat_x = embedding_layer.map_corpus_to_ids(data_x)
+    labels = np.vstack(data_y).astype(np.float32)
+    
+    for out_path, arr in zip(compiled_annotations_paths(path, embedding_layer),
+                             (flat_x.ids, flat_x.offsets, labels)):
+        # unique temporary file, several workers may compile at once; the
+        # key in the name makes every complete file valid
+        atomic_write(out_path, lambda fout: np.save(fout, arr))
+    say("compiled {} into flat token ids\n".format(path))
+
+def load_compiled_annotations(path, embedding_layer, workers = 1):
+    '''
+    Memory-mapped (FlatSequences, labels) of an annotations file, compiles
+    the file first if there is no cache for this file and vocab yet.
+    '''
+    paths = compiled_annotations_paths(path, embedding_layer)
+    if not all(os.path.exists(p) for p in paths):
+        compile_annotations(path, embedding_layer, workers)
+    
+    tokens, offsets, labels = [ np.load(p, mmap_mode = "r") for p in paths ]
+    
+    say("{} examples loaded from {}\n".format(len(offsets) - 1, paths[0]))
+    return FlatSequences(tokens, offsets), labels
     
     
+def parse_embedding_lines(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            parts = line.split()
+            word = parts[0]
+            vals = np.array([ float(x) for x in parts[1:] ])
+            yield word, vals
+
+def _embedding_chunk_worker(task):
+    idx, lines, tmp_dir = task
+    words, vals = [ ], [ ]
+    for word, vector in parse_embedding_lines(task_lines(lines)):
+        words.append(word)
+        vals.append(vector)
+    return save_chunk_arrays(tmp_dir, idx, {
+            "words": np.array(words, dtype = np.string_),
+            "vals": np.array(vals, dtype = np.float32)
+        })
+    
 def load_embedding_iterator(path):
-    file_open = gzip.open if path.endswith(".gz") else open
-    with file_open(path) as fin:
-        for line in fin:
-            line = line.strip()
-            if line:
-                parts = line.split()
-                word = parts[0]
-                vals = np.array([ float(x) for x in parts[1:] ])
-                yield word, vals
+    for word, vals in parse_embedding_lines(iter_file_lines(path)):
+        yield word, vals
+
+def load_embedding_matrix(path, workers = 1):
+    '''
+    Parse an embedding file on a pool of workers, returns a (words, matrix)
+    tuple that can be passed as embs to EmbeddingLayerTf.
+    '''
+    words, vals = [ ], [ ]
+    for paths in parallel_parse(path, _embedding_chunk_worker, workers):
+        arrays = load_chunk_arrays(paths)
+        if not len(arrays["words"]):
+            # only blank lines, vals has no vector size to concatenate with
+            continue
+        words.extend(arrays["words"].tolist())
+        vals.append(arrays["vals"])
+    if not vals:
+        return words, np.zeros((0, 0), dtype = np.float32)
+    return words, np.concatenate(vals)
+                
+class VocabIndex(object):
+    '''
+        Compact word -> id index. The words are kept as one numpy string 
+        array (id order) with the permutation that sorts them, lookups are 
+        done for many words at once with searchsorted. Supports the dict 
+        operations used on a vocab map (get, [], in, len), single words are
+        looked up with one searchsorted as well, no dict is built.
+    '''
+    
+    # words per searchsorted call, bounds the fixed width string arrays
+    chunk_size = 1 << 16
+    
+    def __init__(self, words):
+        self.words = np.array(words, dtype = np.string_)
+        self.order = np.argsort(self.words, kind = "mergesort")
+        
+    def __len__(self):
+        return len(self.words)
+    
+    def has_duplicates(self):
+        sorted_words = self.words[self.order]
+        return bool(np.any(sorted_words[1:] == sorted_words[:-1]))
+    
+    def _lookup_chunk(self, words, default):
+        if not isinstance(words, np.ndarray):
+            # str (annotations) and unicode (json rationales) tokens may be
+            # mixed, numpy can not convert non-ascii str to unicode
+            words = [ w.encode("utf-8") if isinstance(w, unicode) else w
+                      for w in words ]
+        words = np.asarray(words)
+        if words.dtype.kind == "U":
+            words = np.char.encode(words, "utf-8")
+        words = words.astype(np.string_)
+        
+        # every distinct word is searched once
+        uniq, inverse = np.unique(words, return_inverse = True)
+        pos = np.searchsorted(self.words, uniq, sorter = self.order)
+        ids = self.order[np.minimum(pos, len(self.words)-1)]
+        ids = np.where(self.words[ids] == uniq, ids, default)
+        return ids[inverse]
+    
+    def lookup(self, words, default = -1):
+        '''
+            ids of a list of words, default for words not in the index
+        '''
+        n = len(words)
+        out = np.full(n, default, dtype = np.int64)
+        if len(self.words) == 0:
+            return out
+        
+        # in chunks, a single long token only widens the array of its chunk
+        for start in xrange(0, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+            out[start:stop] = self._lookup_chunk(words[start:stop], default)
+        return out
+    
+    def get(self, word, default = None):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        if len(self.words) == 0:
+            return default
+        pos = np.searchsorted(self.words, word, sorter = self.order)
+        idx = self.order[min(pos, len(self.words)-1)]
+        return int(idx) if self.words[idx] == word else default
+    
+    def __getitem__(self, word):
+        idx = self.get(word)
+        if idx is None:
+            raise KeyError(word)
+        return idx
+    
+    def __contains__(self, word):
+        return self.get(word) is not None
                 
 class EmbeddingLayerTf(object):
     '''
@@ -128,68 +458,103 @@ class EmbeddingLayerTf(object):
         vocab           : an iterator of string tokens; the layer will allocate an ID
                             and a vector for each token in it
         oov             : out-of-vocabulary token
-        embs            : an iterator of (word, vector) pairs; these will be added to
-                            the layer
+        embs            : an iterator of (word, vector) pairs or a (words, matrix)
+                            tuple as returned by load_embedding_store; these will
+                            be added to the layer
         fix_init_embs   : whether to fix the initial word vectors loaded from embs
+        n_rows          : number of (word, vector) pairs in embs if known, the
+                            matrix is then allocated once
         
         tensorflow implementation:
             NB using same notation as github page of Tao Lei
     '''
 
-    def __init__(self, n_d, vocab, oov="<unk>", embs=None, fix_init_embs=True):
+    def __init__(self, n_d, vocab, oov="<unk>", embs=None, fix_init_embs=True,
+                 n_rows=None):
+        
+        vocab = list(vocab)
         
         # if the path to the embeddings is not None
         if embs is not None:
             
-            lst_words = [ ]     # list of wordds
-            vocab_map = {}      # map of words to a random integer
-            emb_vals = [ ]      # value of the embeddings
+            if isinstance(embs, tuple):
+                # binary store, the matrix may be memory-mapped so keep it as is
+                lst_words, emb_vals = list(embs[0]), embs[1]
+                n_emb = len(lst_words)
+            else:
+                # fill a preallocated matrix, room is left for the vocab rows
+                lst_words = [ ]     # list of wordds
+                emb_vals = None     # value of the embeddings
+                for word, vector in embs:
+                    if emb_vals is None:
+                        emb_vals = np.empty(((n_rows or 1 << 16) + len(vocab), len(vector)),
+                                            dtype = np.float32)
+                    elif len(lst_words) == len(emb_vals):
+                        emb_vals = grow_matrix(emb_vals, 2*len(emb_vals))
+                    emb_vals[len(lst_words)] = vector
+                    lst_words.append(word)
+                n_emb = len(lst_words)
             
-            for word, vector in embs:
-                assert word not in vocab_map, "Duplicate words in initial embeddings"
-                
-                vocab_map[word] = len(vocab_map)
-                emb_vals.append(vector)
-                lst_words.append(word)
+            # index of words to their position
+            vocab_map = VocabIndex(lst_words)
+            assert not vocab_map.has_duplicates(), "Duplicate words in initial embeddings"
                 
                 
             # fixing initial word embeddings
-            self.init_end = len(emb_vals) if fix_init_embs else -1 
+            self.init_end = n_emb if fix_init_embs else -1 
                 
             # if using other word vectors and the size isn't correct, correct length
-            if n_d != len(emb_vals[0]):
+            if n_d != emb_vals.shape[1]:
                 say("WARNING: n_d ({}) != init word vector size ({}). Use {} instead.\n".format(
-                    n_d, len(emb_vals[0]), len(emb_vals[0])
+                    n_d, emb_vals.shape[1], emb_vals.shape[1]
                     ))
-                n_d = len(emb_vals[0])
+                n_d = emb_vals.shape[1]
                 
-            say("{} pre-trained embeddings loaded.\n".format(len(emb_vals)))
+            say("{} pre-trained embeddings loaded.\n".format(n_emb))
                 
                 # if the word is not in the map, but is some type of token
-            for word in vocab:
-                if word not in vocab_map:
-                    vocab_map[word] = len(vocab_map)
-                    emb_vals.append(random_init((n_d,))*(0.001 if word != oov else 0.0))
+            # (one lookup for the whole vocab, a set for the new words)
+            in_map = vocab_map.lookup(vocab) >= 0 if vocab else [ ]
+            added = set()
+            for word, found in zip(vocab, in_map):
+                if not found and word not in added:
+                    added.add(word)
                     lst_words.append(word)
+            extra_words = lst_words[n_emb:]
             
-            # create massive matrix, a mapping and the words
-            emb_vals = np.vstack(emb_vals)
+            # create massive matrix, a mapping and the words. All new rows are
+            # drawn in one call, a store that already holds the special tokens
+            # is used without copying.
+            if extra_words:
+                extra_vals = random_init((len(extra_words), n_d))*0.001
+                extra_vals[np.array([ w == oov for w in extra_words ], dtype = bool)] = 0.0
+                
+                if isinstance(embs, tuple):
+                    emb_vals = np.vstack([emb_vals, extra_vals.astype(emb_vals.dtype)])
+                else:
+                    if len(lst_words) > len(emb_vals):
+                        emb_vals = grow_matrix(emb_vals, len(lst_words))
+                    emb_vals[n_emb:len(lst_words)] = extra_vals
+                vocab_map = VocabIndex(lst_words)
+            
+            if not isinstance(embs, tuple) and len(emb_vals) != len(lst_words):
+                # a slice would keep the whole preallocated buffer alive
+                emb_vals = np.array(emb_vals[:len(lst_words)], copy = True)
             self.vocab_map = vocab_map
-            self.lst_words = lst_words
+            self.lst_words = vocab_map.words
                         
         else:
                 
             # otherwise randomly initialize the word vectors
-            lst_words = [ ]
-            vocab_map = {}
+            lst_words, seen = [ ], set()
             for word in vocab:
-                if word not in vocab_map:
-                    vocab_map[word] = len(vocab_map)
+                if word not in seen:
+                    seen.add(word)
                     lst_words.append(word)
 
-            self.lst_words = lst_words
-            self.vocab_map = vocab_map
-            emb_vals = random_init((len(self.vocab_map), n_d))
+            self.vocab_map = VocabIndex(lst_words)
+            self.lst_words = self.vocab_map.words
+            emb_vals = random_init((len(self.vocab_map), n_d)).astype(np.float32)
             self.init_end = -1  # set it so the word vectors can be updated
                 
             
@@ -220,10 +585,12 @@ class EmbeddingLayerTf(object):
             
             
     def map_to_words(self, ids):
-        # trivial
+        # vectorized lookup, ids outside the vocab map to <err>
             
-        n_V, lst_words = self.n_V, self.lst_words
-        return [ lst_words[i] if i < n_V else "<err>" for i in ids ]
+        ids = np.asarray(ids, dtype = np.int64)
+        words = self.lst_words[np.clip(ids, 0, self.n_V-1)].astype(object)
+        words[ids >= self.n_V] = "<err>"
+        return words.tolist()
         
         
     def map_to_ids(self, words, filter_oov=False):
@@ -238,19 +605,50 @@ class EmbeddingLayerTf(object):
             return the numpy array of word IDs
         '''
         
-        vocab_map = self.vocab_map
-        oov_id = self.oov_id
+        ids = self.vocab_map.lookup(words, self.oov_id).astype("int32")
         if filter_oov:
-            not_oov = lambda x: x!=oov_id
-            return np.array(
-                    filter(not_oov, [ vocab_map.get(x, oov_id) for x in words ]),
-                    dtype="int32"
-                )
+            return ids[ids != self.oov_id]
         else:
-            return np.array(
-                    [ vocab_map.get(x, oov_id) for x in words ],
-                    dtype="int32"
-                )
+            return ids
+    
+    def map_corpus_to_ids(self, docs, filter_oov=False):
+        '''
+            map a whole corpus of token lists in one call
+            Inputs
+            ------
+            docs            : list of lists of string tokens
+            filter_oov      : whether to remove oov tokens
+            Outputs
+            -------
+            return FlatSequences with the word IDs of all documents
+        '''
+        
+        lengths = np.fromiter((len(doc) for doc in docs), dtype = np.int64,
+                              count = len(docs))
+        
+        # documents are mapped in chunks of about chunk_size tokens, the
+        # corpus is never flattened into one token list
+        ids = np.empty(int(lengths.sum()), dtype = np.int32)
+        chunk_size = self.vocab_map.chunk_size
+        tokens, pos = [ ], 0
+        for doc in docs:
+            tokens.extend(doc)
+            if len(tokens) >= chunk_size:
+                ids[pos:pos+len(tokens)] = self.map_to_ids(tokens)
+                pos += len(tokens)
+                tokens = [ ]
+        if tokens:
+            ids[pos:pos+len(tokens)] = self.map_to_ids(tokens)
+        
+        if filter_oov:
+            keep = ids != self.oov_id
+            doc_idx = np.repeat(np.arange(len(docs)), lengths)
+            lengths = np.bincount(doc_idx[keep], minlength = len(docs))
+            ids = ids[keep]
+        
+        offsets = np.zeros(len(docs) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = offsets[1:])
+        return FlatSequences(ids, offsets)
 
     def forward(self, x):
         '''
@@ -274,24 +672,360 @@ class EmbeddingLayerTf(object):
     def params(self, param_list):
         self.embeddings.set_value(param_list[0].get_value())
         
-def create_embedding_layer(path):
+def embedding_store_base(path):
+    '''
+    Path of an embedding file without its extensions, e.g. 
+    data/emb.200.txt.gz -> data/emb.200
+    '''
+    base = path
+    for ext in (".gz", ".txt", ".npy"):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return base
+
+def embedding_store_paths(path):
+    '''
+    Paths of the binary store (matrix, vocab) that belongs to an embedding
+    file, e.g. data/emb.200.txt.gz -> data/emb.200.npy, data/emb.200.vocab.txt
+    '''
+    base = embedding_store_base(path)
+    return base + ".npy", base + ".vocab.txt"
+
+def save_embedding_store(path, embedding_layer, dtype = "float32"):
+    '''
+    Write the words and the matrix of an embedding layer as a binary store.
+    Every file is written under a unique temporary name and renamed, so
+    concurrent jobs never see a half written file. The two renames are not
+    one step, load_embedding_store checks that vocab and matrix match.
+    '''
+    emb_path, vocab_path = embedding_store_paths(path)
+    
+    def write_vocab(fout):
+        for word in embedding_layer.lst_words:
+            fout.write(word + "\n")
+    
+    atomic_write(vocab_path, write_vocab, "w")
+    atomic_write(emb_path, lambda fout: np.save(fout, 
+                    np.asarray(embedding_layer.embeddings, dtype = dtype)))
+    say("embedding store written to {}\n".format(emb_path))
+
+def load_embedding_store(path):
+    '''
+    Load the words and memory-map the matrix of a binary store, processes
+    on the same host share the pages of the matrix.
+    '''
+    emb_path, vocab_path = embedding_store_paths(path)
+    with open(vocab_path) as fin:
+        words = [ line.rstrip("\n") for line in fin ]
+    embs = np.load(emb_path, mmap_mode = "r")
+    if len(words) != embs.shape[0]:
+        # e.g. written by two jobs at the same time
+        raise IOError("vocab and matrix of {} differ".format(emb_path))
+    return words, embs
+
+def has_embedding_store(path):
+    return all(os.path.exists(p) for p in embedding_store_paths(path))
+
+def convert_embeddings(path, dtype = "float32", workers = 1):
+    '''
+    One-time conversion of a text embedding file into a binary store, the
+    special tokens are included so the stored matrix is used as is.
+    '''
     embedding_layer = EmbeddingLayerTf(
             n_d = 200,
             vocab = [ "<unk>", "<padding>" ],
-            embs = load_embedding_iterator(path),
+            embs = load_embeddings(path, workers),
+            oov = "<unk>",
+            fix_init_embs = False,
+            n_rows = count_embedding_rows(path)
+        )
+    save_embedding_store(path, embedding_layer, dtype)
+
+def load_embeddings(path, workers = 1):
+    if workers > 1:
+        return load_embedding_matrix(path, workers)
+    return load_embedding_iterator(path)
+
+def count_embedding_rows(path):
+    '''
+    Upper bound of the number of vectors in an embedding file (its lines),
+    from the line index. The index of a gzipped file is only used when it
+    already exists, that of a plain file is cheap to build. None if unknown.
+    '''
+    try:
+        index = load_line_index(path, build = not path.endswith(".gz"))
+    except (IOError, OSError):
+        return None
+    return index.n_lines if index is not None else None
+
+def create_embedding_layer(path, use_store = True, store_dtype = "float32",
+                           workers = 1):
+    if use_store:
+        if not has_embedding_store(path):
+            say("converting {} into a binary store\n".format(path))
+            convert_embeddings(path, store_dtype, workers)
+        try:
+            embs = load_embedding_store(path)
+        except IOError:
+            say("rebuilding the inconsistent store of {}\n".format(path))
+            convert_embeddings(path, store_dtype, workers)
+            embs = load_embedding_store(path)
+    else:
+        embs = load_embeddings(path, workers)
+    
+    # rows of the parsed file, a store or parsed matrix knows its size
+    n_rows = None if isinstance(embs, tuple) else count_embedding_rows(path)
+        
+    embedding_layer = EmbeddingLayerTf(
+            n_d = 200,
+            vocab = [ "<unk>", "<padding>" ],
+            embs = embs,
             oov = "<unk>",
             #fix_init_embs = True
+            fix_init_embs = False,
+            n_rows = n_rows
+        )
+    return embedding_layer
+    
+def create_pruned_embedding_layer(path, corpus_words, out_path,
+                                  use_store = True, store_dtype = "float32",
+                                  workers = 1):
+    '''
+    Embedding layer that only keeps the pre-trained rows of the words in
+    corpus_words plus <unk> and <padding>, with densely remapped ids. The
+    pruned vocab and matrix are written as a binary store at out_path, it
+    can be passed directly as --embedding later on. An existing store at
+    out_path with the same words is used as is.
+    '''
+    full_layer = create_embedding_layer(path, use_store, store_dtype, workers)
+    specials = ("<unk>", "<padding>")
+    
+    keep = full_layer.vocab_map.lookup(list(corpus_words) + list(specials))
+    keep = np.unique(keep[keep >= 0])
+    words = full_layer.lst_words[keep]
+    
+    if has_embedding_store(out_path):
+        try:
+            stored_words, stored_embs = load_embedding_store(out_path)
+        except IOError:
+            stored_words = None
+        if stored_words == words.tolist():
+            say("using the pruned store {}\n".format(out_path))
+            return EmbeddingLayerTf(
+                    n_d = 200,
+                    vocab = list(specials),
+                    embs = (stored_words, stored_embs),
+                    oov = "<unk>",
+                    fix_init_embs = False
+                )
+    
+    embs = np.asarray(full_layer.embeddings[keep])
+    del full_layer
+    
+    say("pruned vocab to {} words used in the corpus\n".format(len(words)))
+    
+    embedding_layer = EmbeddingLayerTf(
+            n_d = 200,
+            vocab = list(specials),
+            embs = (words, embs),
+            oov = "<unk>",
             fix_init_embs = False
         )
+    save_embedding_store(out_path, embedding_layer, store_dtype)
     return embedding_layer
     
-def read_rationales(path):
-    data = [ ]
+def parse_rationale_lines(lines):
+    return [ json.loads(line) for line in lines ]
+
+def _rationale_chunk_worker(task):
+    idx, lines, tmp_dir = task
+    return parse_rationale_lines(task_lines(lines))
+    
+def read_rationales(path, workers = 1, line_range = None):
+    if workers > 1 and line_range is None:
+        data = [ ]
+        for items in parallel_parse(path, _rationale_chunk_worker, workers):
+            data.extend(items)
+    else:
+        data = parse_rationale_lines(iter_file_lines(path, line_range))
+    return data
+
+##############################
+####### Parallel parsing #####
+##############################
+
+def open_file(path):
     fopen = gzip.open if path.endswith(".gz") else open
-    with fopen(path) as fin:
+    return fopen(path)
+
+def iter_file_lines(path, line_range = None):
+    '''
+    Lines of a (gzipped) file, or only the lines [a, b) of line_range.
+    '''
+    if line_range is not None:
+        for line in load_line_index(path).read_lines(*line_range):
+            yield line
+        return
+    with open_file(path) as fin:
         for line in fin:
-            item = json.loads(line)
-            data.append(item)
-    return data
+            yield line
 
+def iter_line_chunks(path, chunk_lines):
+    with open_file(path) as fin:
+        while True:
+            lines = list(itertools.islice(fin, chunk_lines))
+            if not lines:
+                return
+            yield lines
 
+# indexes loaded by this (worker) process
+_line_indexes = { }
+
+def task_lines(lines):
+    '''
+    Lines of a parse task, given either as the lines themselves or as a
+    (path, start, stop) range that the worker reads through the index.
+    '''
+    if isinstance(lines, tuple):
+        path, start, stop = lines
+        if path not in _line_indexes:
+            _line_indexes[path] = load_line_index(path, build = False)
+        return _line_indexes[path].read_lines(start, stop)
+    return lines
+
+def save_chunk_arrays(tmp_dir, idx, arrays):
+    '''
+    Store the arrays parsed by a worker as .npy files, returns their paths.
+    '''
+    paths = { }
+    for name, arr in arrays.iteritems():
+        paths[name] = os.path.join(tmp_dir, "{}.{}.npy".format(idx, name))
+        np.save(paths[name], arr)
+    return paths
+
+def load_chunk_arrays(paths):
+    arrays = { }
+    for name, path in paths.iteritems():
+        arrays[name] = np.load(path)
+        os.remove(path)
+    return arrays
+
+def parallel_parse(path, worker, workers, chunk_lines = 20000, ahead = 2):
+    '''
+    Split a (gzipped) file into chunks of lines and parse them on a pool of
+    processes. worker((idx, lines, tmp_dir)) runs in the pool, results are
+    yielded in file order so the output matches the serial readers.
+    At most ahead chunks per worker are read and submitted before their
+    results are consumed, so memory stays bounded for any file size.
+    
+    With the random-access index of the file every worker decompresses and
+    reads its own line range, otherwise the lines are read here and sent.
+    '''
+    try:
+        index = load_line_index(path)
+    except (IOError, OSError):
+        index = None
+    
+    if index is not None:
+        tasks = ((path, start, start + chunk_lines) 
+                    for start in xrange(0, index.n_lines, chunk_lines))
+    else:
+        tasks = iter_line_chunks(path, chunk_lines)
+        
+    tmp_dir = tempfile.mkdtemp(prefix = "rationale_parse_")
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    try:
+        for idx, lines in enumerate(tasks):
+            pending.append(pool.apply_async(worker, ((idx, lines, tmp_dir),)))
+            if len(pending) >= ahead * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+##############################
+####### Prefetching ##########
+##############################
+
+class BatchPrefetcher(object):
+    '''
+    Iterates over prepare(i) for every i in order. With size > 0 a background
+    thread prepares up to size items ahead while the consumer is busy (e.g.
+    in sess.run), with size 0 items are prepared on demand.
+    Counts how often the consumer found the queue empty (starved) and how
+    long it waited for items in total, to tell whether input is the
+    bottleneck.
+    '''
+    
+    def __init__(self, order, prepare, size = 2, name = "batches"):
+        self.order = list(order)
+        self.prepare = prepare
+        self.size = size
+        self.name = name
+        
+        self.n_items = 0
+        self.n_starved = 0
+        self.wait_time = 0.0
+        
+    def __len__(self):
+        return len(self.order)
+        
+    def _put(self, queue, stop, item):
+        # gives up when the consumer is gone
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout = 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+        
+    def _produce(self, queue, stop):
+        try:
+            for i in self.order:
+                if not self._put(queue, stop, (True, self.prepare(i))):
+                    return
+        except Exception:
+            # handed to the consumer, raised there
+            self._put(queue, stop, (False, sys.exc_info()))
+    
+    def __iter__(self):
+        if self.size <= 0:
+            for i in self.order:
+                start = time.time()
+                item = self.prepare(i)
+                self.wait_time += time.time() - start
+                self.n_items += 1
+                yield item
+            return
+        
+        queue = Queue.Queue(maxsize = self.size)
+        stop = threading.Event()
+        thread = threading.Thread(target = self._produce, args = (queue, stop))
+        thread.daemon = True
+        thread.start()
+        
+        try:
+            for _ in xrange(len(self.order)):
+                if queue.empty():
+                    self.n_starved += 1
+                start = time.time()
+                ok, item = queue.get()
+                self.wait_time += time.time() - start
+                
+                if not ok:
+                    raise item[0], item[1], item[2]
+                
+                self.n_items += 1
+                yield item
+        finally:
+            # also stops the producer when the consumer leaves early
+            stop.set()
+            thread.join()
+    
+    def report(self):
+        return "{}: starved {}/{} steps, waited {:.2f}s for input".format(
+                        self.name, self.n_starved, self.n_items, self.wait_time)
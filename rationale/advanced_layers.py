@@ -18,7 +18,7 @@ from tensorflow.python.ops.math_ops import tanh
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops import array_ops
 from tensorflow.python.util import nest
-from basic_layers import BasicRNNCell, _linear
+from basic_layers import BasicRNNCell, _linear, _linear_variables
 
 tf.set_random_seed(2345)
 
@@ -44,6 +44,137 @@ def ln(tensor, scope = None, epsilon = 1e-5):
 
     return LN_initial * scale + shift
 
+###############################
+#######   RCNN scan   #########
+###############################
+
+def scan_hidden(fn, elems, initializer, output_fn, parallel_iterations = 10):
+    '''
+    tf.scan that carries the state but only stacks output_fn(state) of every
+    step, e.g. h_t instead of the full RCNN state with its order c states.
+    elems and the state may be nested tuples, like for tf.scan.
+    Returns the stacked outputs, nested like output_fn(initializer).
+    '''
+    elems_flat = nest.flatten(elems)
+    n_steps = tf.shape(elems_flat[0])[0]
+    
+    elems_ta = [ tf.TensorArray(e.dtype, size = n_steps).unpack(e)
+                 for e in elems_flat ]
+    
+    outputs_flat = nest.flatten(output_fn(initializer))
+    outputs_ta = [ tf.TensorArray(o.dtype, size = n_steps)
+                   for o in outputs_flat ]
+    
+    def body(t, state, outputs_ta):
+        x_t = nest.pack_sequence_as(elems, [ ta.read(t) for ta in elems_ta ])
+        state = fn(state, x_t)
+        outputs_ta = [ ta.write(t, o) for ta, o in 
+                       zip(outputs_ta, nest.flatten(output_fn(state))) ]
+        return t + 1, state, outputs_ta
+    
+    _, _, outputs_ta = tf.while_loop(lambda t, *_: t < n_steps, body,
+                                     [tf.constant(0), initializer, outputs_ta],
+                                     parallel_iterations = parallel_iterations)
+    
+    outputs = [ ta.pack() for ta in outputs_ta ]
+    for o, o0 in zip(outputs, outputs_flat):
+        o.set_shape(tf.TensorShape([None]).concatenate(o0.get_shape()))
+    
+    return nest.pack_sequence_as(output_fn(initializer), outputs)
+
+def scan_rcnn(cell, inputs, initializer, mask = None, precompute = False,
+              hidden_only = False):
+    '''
+    Run an RCNN cell over a [len, batch, n_in] sequence with tf.scan.
+    mask is passed along with the inputs for ExtRCNNCell. With precompute the
+    input projections of the whole sequence are done before the scan (see
+    RCNNCell.project_inputs), a fused cell gets its weights packed here.
+    With hidden_only only h [len, batch, n_d] is returned instead of the
+    states (see scan_hidden).
+    '''
+    if precompute:
+        inputs = cell.project_inputs(inputs)
+    elif cell.fused:
+        cell.pack_weights(inputs.get_shape()[2].value)
+    
+    elems = inputs if mask is None else (inputs, mask)
+    
+    if hidden_only:
+        return scan_hidden(cell, elems, initializer, cell.hidden)
+    
+    return tf.scan(cell, elems, initializer = initializer)
+
+def scan_bidirectional(cell_fw, cell_bw, inputs, initializer_fw,
+                       initializer_bw, precompute = False, hidden_only = False):
+    '''
+    Run a forward and a backward RCNN cell over inputs in a single tf.scan.
+    Every iteration advances both directions, the two steps are independent
+    so they can run concurrently, and there is one while loop on the critical
+    path instead of two after each other.
+    Returns the states of both cells like two separate scan_rcnn calls, i.e.
+    the backward states are in reversed time order. With hidden_only only
+    their h parts (see scan_hidden).
+    '''
+    inputs_reversed = inputs[::-1]
+    
+    if precompute:
+        inputs = cell_fw.project_inputs(inputs)
+        inputs_reversed = cell_bw.project_inputs(inputs_reversed)
+    else:
+        for cell in (cell_fw, cell_bw):
+            if cell.fused:
+                cell.pack_weights(inputs.get_shape()[2].value)
+    
+    def step(states, x):
+        return (cell_fw(states[0], x[0]), cell_bw(states[1], x[1]))
+    
+    if hidden_only:
+        return scan_hidden(step, (inputs, inputs_reversed),
+                           (initializer_fw, initializer_bw),
+                           lambda states: (cell_fw.hidden(states[0]),
+                                           cell_bw.hidden(states[1])))
+    
+    return tf.scan(step, (inputs, inputs_reversed),
+                   initializer = (initializer_fw, initializer_bw))
+
+def compact_selected(x, z):
+    '''
+    Gather the selected steps of every column of a sequence into a shorter
+    one.
+    x [len, batch, n] and z [len, batch, 1] of 0/1 --> x_c [k, batch, n] and
+    z_c [k, batch, 1], k the largest number of selected steps of a column
+    (at least 1). Selected steps keep their order and end at the last slot,
+    unused slots come first with z_c = 0 so a masked scan leaves its state
+    untouched over them and the final state is the last row.
+    '''
+    n = x.get_shape()[2].value
+    
+    z2 = tf.transpose(tf.squeeze(z, squeeze_dims = [2]))  # batch, len
+    batch_size = tf.shape(z2)[0]
+    length = tf.shape(z2)[1]
+    k = tf.maximum(tf.cast(tf.reduce_max(tf.reduce_sum(z2, 1)), tf.int32), 1)
+    
+    # z*(t+1) is 0 for steps that are not selected and grows with t otherwise,
+    # top_k gives the selected steps last to first
+    steps = tf.cast(tf.range(1, length + 1), tf.float32)
+    _, idx = tf.nn.top_k(z2 * steps, k)
+    idx = idx[:, ::-1]
+    
+    # positions in the flattened [batch*len] sequences
+    flat_idx = idx + tf.expand_dims(tf.range(batch_size) * length, 1)
+    flat_idx = tf.reshape(flat_idx, [-1])
+    
+    x_flat = tf.reshape(tf.transpose(x, [1, 0, 2]), [-1, n])
+    x_c = tf.reshape(tf.gather(x_flat, flat_idx), tf.pack([batch_size, k, n]))
+    x_c = tf.transpose(x_c, [1, 0, 2])
+    x_c.set_shape([None, None, n])
+    
+    z_c = tf.reshape(tf.gather(tf.reshape(z2, [-1]), flat_idx),
+                     tf.pack([batch_size, k]))
+    z_c = tf.expand_dims(tf.transpose(z_c), 2)
+    
+    return x_c, z_c
+
 ###############################
 #######    RCNNCell   #########
 ###############################
@@ -52,6 +183,16 @@ class RCNNCell(RNNCell):
     RCNN Cell Tensorflow implementation from the paper: Semi-supervised Question
     Retrieval with gated Convolutions. 
     
+    The input side of the cell (the order filters and the input halves of the
+    forget gate and outgate) does not depend on the state. project_inputs
+    computes it for a whole sequence in one matmul, after which the cell takes
+    the projections as inputs and only does the recurrent part per step.
+    
+    With fused = True the same variables are packed (pack_weights) into one
+    [n_in, projection_size] input matrix and one recurrent matrix for the
+    gates, so a step does two matmuls instead of order + 2 (+1 outgate).
+    The packing is a concat of the original variables, checkpoints are
+    interchangeable with the unfused cell.
     '''
     def Layer(self, n_in, n_out, order, inputs,
               hasbias = False, scope = None,
@@ -60,6 +201,24 @@ class RCNNCell(RNNCell):
                                                           0.05, 
                                                           seed = 2345) ): 
         
+        W, B = self.layer_variables(n_in, n_out, order, hasbias, scope,
+                                    reuse, initializer)
+        
+        out = tf.matmul(inputs, W)
+        
+        # add bias if asked so
+        if B is not None:
+            out = out + B
+    
+        return out
+    
+    def layer_variables(self, n_in, n_out, order,
+                        hasbias = False, scope = None,
+                        reuse = None, 
+                        initializer = tf.random_uniform_initializer(-0.05,
+                                                                    0.05, 
+                                                                    seed = 2345) ): 
+        
         # this determines what the variable scope will be. dynamic_rnn messes 
         # with the scope and adds rnn/ in front of it. This corrects it.
         if scope:
@@ -75,17 +234,14 @@ class RCNNCell(RNNCell):
                                     initializer = initializer
                                     )
             
-            out = tf.matmul(inputs, W)
-            
-            # add bias if asked so
+            B = None
             if hasbias:
                 B = tf.get_variable( 'biases_'+ str(order),
                                     [1],
                                     initializer = tf.constant_initializer(0.0), 
                                     dtype = tf.float32)
-                out = out + B
         
-            return out
+            return W, B
     
     def __init__(self, 
                  num_units,
@@ -101,7 +257,8 @@ class RCNNCell(RNNCell):
                  idx = 1,              
                  use_ln = False, 
                  initializer = tf.random_uniform_initializer(-0.05, 0.05, 
-                                                             seed = 2345)       
+                                                             seed = 2345),
+                 fused = False
                  ):
         
         '''
@@ -112,6 +269,8 @@ class RCNNCell(RNNCell):
             has_outgate     : whether to add a output gate as in LSTM; this can be
                               useful for language modeling
             mode            : 0 if non-linear filter; 1 if linear filter (default)
+            fused           : one input and one recurrent matmul per step,
+                              see pack_weights
             
         Tensorflow Edition
         '''
@@ -137,6 +296,14 @@ class RCNNCell(RNNCell):
         self.useln = use_ln
         
         self.initializer = initializer 
+        
+        # set by project_inputs, the cell then takes projected inputs
+        self.projected = False
+        self.extra_weights = None
+        
+        # packed weights, set by pack_weights
+        self.fused = fused
+        self._w_in = None
 
     @property
     def state_size(self):
@@ -146,16 +313,115 @@ class RCNNCell(RNNCell):
     def output_size(self):
         return self._num_units
     
+    @property
+    def projection_size(self):
+        # order filters, forget gate and optionally the outgate
+        return self._num_units*(self._order + 1 + int(self._has_outgate))
+    
     
     def zero_state(self, batch_size, dtype = tf.float32):
-
-        zeros = tf.zeros([batch_size,
-                           self._state_size*(self._order + 1)], 
+        
+        # batch_size may be a tensor, e.g. tf.shape(x)[1]
+        zeros = tf.zeros(tf.pack([batch_size,
+                                  self._state_size*(self._order + 1)]), 
                            name = 'initstateLT1', 
                            dtype = tf.float32)
         
 
         return zeros
+    
+    def hidden(self, state):
+        '''
+        h_t of a [batch, (order+1)*n_d] state, the c states come first.
+        '''
+        return state[:, self._num_units*self._order:]
+    
+    def input_weights(self, n_in, scope = None, scope2 = None):
+        '''
+        Input side weights of the cell packed as one matrix.
+        Gets (or creates) the same variables as __call__, so checkpoints are
+        interchangeable. Returns W [n_in, projection_size] and its bias; the
+        recurrent halves of the gates are kept on the cell.
+        '''
+        n_d = self._num_units
+        self.name = "RCNN_cell" + '_%s'% (str(self._idx))
+        
+        with vs.variable_scope(scope or self.name, reuse = self.reuse) as var_scope: 
+            self._bias_out = tf.get_variable( 'bias_out' + '_%s'%self._idx,
+                            [self._num_units,],
+                            initializer = tf.constant_initializer(0.0),
+                            dtype = tf.float32)
+            
+            # forget cell, BasicRNNCell/Linear over [inputs, ht_m1]
+            with vs.variable_scope('BasicRNNCell'):
+                m_forget, b_forget = _linear_variables(n_in + n_d, n_d, True)
+        
+        weights, biases = [ ], [ ]
+        for i in range(self._order):
+            W, B = self.layer_variables(n_in, n_d, i,
+                                        hasbias = self._has_bias,
+                                        scope = scope2,
+                                        reuse = self.reuse,
+                                        initializer = self.initializer)
+            weights.append(W)
+            biases.append(tf.tile(B, [n_d]) if B is not None else
+                          tf.zeros([n_d], dtype = tf.float32))
+        
+        weights.append(m_forget[:n_in])
+        biases.append(b_forget)
+        recurrent = [m_forget[n_in:]]
+        
+        if self._has_outgate:
+            with vs.variable_scope(scope or self.name, reuse = self.reuse ) as var_scope:
+                m_out, b_out = _linear_variables(n_in + n_d, n_d, True, 1.0,
+                                scope = scope or "RCNN_cell" + '_%s'% \
+                                (str(self._idx) + 'out_t'))
+            weights.append(m_out[:n_in])
+            biases.append(b_out)
+            recurrent.append(m_out[n_in:])
+        
+        # ht_m1 side of the gates, [n_d, n_d] or [n_d, 2*n_d] with an outgate
+        self._u_rec = tf.concat(1, recurrent)
+            
+        return tf.concat(1, weights), tf.concat(0, biases)
+    
+    def pack_weights(self, n_in, scope = None, scope2 = None):
+        '''
+        Pack the weights of a fused cell, outside of the scan so the concats
+        are not repeated every step. scope and scope2 as in __call__.
+        '''
+        self._w_in, self._b_in = self.input_weights(n_in, scope, scope2)
+        return self._w_in, self._b_in
+    
+    def project_inputs(self, inputs, n_extra = 0, scope = None, scope2 = None):
+        '''
+        Precompute the input side of the cell for a whole sequence.
+        inputs [len, batch, n_in] --> [len, batch, projection_size], done as
+        one [len*batch, n_in] matmul instead of order + 1 matmuls per step.
+        The last n_extra input columns are not part of inputs (e.g. z in the
+        Z layer, which is only known inside the scan); add_inputs adds them
+        per step.
+        '''
+        n_x = inputs.get_shape()[2].value
+        W, b = self.input_weights(n_x + n_extra, scope, scope2)
+        
+        shape = tf.shape(inputs)
+        flat = tf.reshape(inputs, [-1, n_x])
+        proj = tf.matmul(flat, W[:n_x]) + b
+        proj = tf.reshape(proj, tf.pack([shape[0], shape[1],
+                                         self.projection_size]))
+        proj.set_shape([None, None, self.projection_size])
+        
+        self.extra_weights = W[n_x:] if n_extra else None
+        self.projected = True
+        
+        return proj
+    
+    def add_inputs(self, proj_t, extra_t):
+        '''
+        Add the contribution of the extra input columns of project_inputs.
+        '''
+        return proj_t + tf.matmul(extra_t, self.extra_weights)
         
     # Note swap state and inputs if NOT using scan        
     def __call__(self, 
@@ -170,28 +436,35 @@ class RCNNCell(RNNCell):
         Recurrent Convolutional Neural Network
         
         '''
+        n_d = self._num_units
         
-        input_size = inputs.get_shape()[1] # 256
-        
-        # ensure correct scope is used when using dynamic rnn
-        self.name = "RCNN_cell" + '_%s'% (str(self._idx))
+        # depending on the state, take the appropriate slice
+        if len(state.get_shape())>1: 
+            ht_m1 = state[:,self._num_units*self._order:]
+        else:
+            ht_m1 = state[self._num_units*self._order:]
         
-        with vs.variable_scope(scope or self.name, reuse = self.reuse) as var_scope: 
-            
-            # depending on the state, take the appropriate slice
-            if len(state.get_shape())>1: 
-                ht_m1 = state[:,self._num_units*self._order:]
+        if self.projected or self.fused:
+            if self.projected:
+                # inputs are the rows of project_inputs
+                proj_t = inputs
             else:
-                ht_m1 = state[self._num_units*self._order:]
-            
-            bias = tf.get_variable( 'bias_out' + '_%s'%self._idx,
-                            [self._num_units,],
-                            initializer = tf.constant_initializer(0.0),
-                            dtype = tf.float32)
-            
-            # forget cell
-            forget_cell = BasicRNNCell(self._num_units, activation = tf.nn.sigmoid)
-            forget_t = forget_cell(inputs, ht_m1)[0]
+                if self._w_in is None:
+                    raise ValueError("pack_weights must be called before "
+                                     "running a fused RCNNCell")
+                proj_t = tf.matmul(inputs, self._w_in) + self._b_in
+                
+            # recurrent halves of the gates in one matmul
+            k = n_d*self._order
+            rec_t = tf.matmul(ht_m1, self._u_rec)
+            in_list = [proj_t[:, n_d*i:n_d*(i+1)] for i in range(self._order)]
+            forget_t = sigmoid(proj_t[:, k:k+n_d] + rec_t[:, :n_d])
+            if self._has_outgate:
+                out_t = proj_t[:, k+n_d:] + rec_t[:, n_d:]
+            bias = self._bias_out
+        else:
+            in_list, forget_t, out_t, bias = self._gates(state, ht_m1, inputs,
+                                                         scope, scope2)
             
         lst = [ ]   
         for i in range(self._order):
@@ -204,16 +477,7 @@ class RCNNCell(RNNCell):
             else:
                 c_i_tm1 = state[self._num_units*i:self._num_units*i+self._num_units]
             
-            # Create feed forward layer
-            in_i_t = self.Layer(input_size,
-                                self._num_units,
-                                i,
-                                inputs,
-                                hasbias = self._has_bias,
-                                scope = scope2,
-                                reuse = self.reuse,
-                                initializer = self.initializer)
-            
+            in_i_t = in_list[i]
             
             # formulae for the sum of the n_grams
             if i == 0:
@@ -244,15 +508,6 @@ class RCNNCell(RNNCell):
                 h_t = self._activation(c_i_t + bias, name = 'no_outgate')
             
         else:
-            with vs.variable_scope(scope or self.name, reuse = self.reuse ) as var_scope:
-                out_t = _linear([inputs, ht_m1],
-                                self._num_units,
-                                True, 1.0,
-                                scope = scope or "RCNN_cell" + '_%s'% \
-                                (str(self._idx) + 'out_t'))
-                
-                
-            
             h_t = out_t * self._activation(c_i_t + bias, name = 'with_outgate')
             
         # add the outgate to the next state
@@ -263,6 +518,50 @@ class RCNNCell(RNNCell):
             return tf.concat(1,lst)
         else:
             return tf.concatenate(lst)
+    
+    def _gates(self, state, ht_m1, inputs, scope = None, scope2 = None):
+        '''
+        Filter inputs, forget gate and outgate of one step from raw inputs.
+        '''
+        input_size = inputs.get_shape()[1] # 256
+        
+        # ensure correct scope is used when using dynamic rnn
+        self.name = "RCNN_cell" + '_%s'% (str(self._idx))
+        
+        with vs.variable_scope(scope or self.name, reuse = self.reuse) as var_scope: 
+            
+            bias = tf.get_variable( 'bias_out' + '_%s'%self._idx,
+                            [self._num_units,],
+                            initializer = tf.constant_initializer(0.0),
+                            dtype = tf.float32)
+            
+            # forget cell
+            forget_cell = BasicRNNCell(self._num_units, activation = tf.nn.sigmoid)
+            forget_t = forget_cell(inputs, ht_m1)[0]
+            
+        in_list = [ ]
+        for i in range(self._order):
+            
+            # Create feed forward layer
+            in_list.append(self.Layer(input_size,
+                                      self._num_units,
+                                      i,
+                                      inputs,
+                                      hasbias = self._has_bias,
+                                      scope = scope2,
+                                      reuse = self.reuse,
+                                      initializer = self.initializer))
+        
+        out_t = None
+        if self._has_outgate:
+            with vs.variable_scope(scope or self.name, reuse = self.reuse ) as var_scope:
+                out_t = _linear([inputs, ht_m1],
+                                self._num_units,
+                                True, 1.0,
+                                scope = scope or "RCNN_cell" + '_%s'% \
+                                (str(self._idx) + 'out_t'))
+        
+        return in_list, forget_t, out_t, bias
         
 
 ###############################
@@ -373,7 +672,11 @@ class Z_Layer(object):
                  state_is_tuple = True,  
                  activation = tanh,
                  initializer = tf.random_uniform_initializer(-0.05, 0.05,
-                                                             seed = 2345)
+                                                             seed = 2345),
+                 precompute = False,
+                 fused = False,
+                 threshold = None,
+                 hidden_only = False
                 ):
         
         '''
@@ -383,6 +686,11 @@ class Z_Layer(object):
              inputs constructor:
              num_units = number of output units
              activation = activation
+             precompute = do the input projections of the rlayer and of W1
+                          for the whole sequence before the scans
+             fused = use a fused rlayer, see RCNNCell
+             threshold = if given, z_t = pz_t >= threshold instead of a sample
+             hidden_only = forward_all only keeps h of the rlayer states
             
         Tensorflow Edition
         '''
@@ -390,6 +698,9 @@ class Z_Layer(object):
         self._n_in = n_in
         self._activation = activation
         self._idx = 'ZLayer'
+        self.precompute = precompute
+        self.threshold = threshold
+        self.hidden_only = hidden_only
         
         with vs.variable_scope('ZLayerWeights') as var_scope: 
             w1 = tf.get_variable('W1', [n_in,1], dtype = tf.float32, 
@@ -402,7 +713,7 @@ class Z_Layer(object):
                                    dtype = tf.float32)
             
         self.rlayer = RCNNCell(self._n_hidden, idx = self._idx, 
-                               initializer = initializer )
+                               initializer = initializer, fused = fused)
         
         if not state_is_tuple:
             print 'Please use the tuple function. Not implemented for usage with tensors.'
@@ -452,13 +763,16 @@ class Z_Layer(object):
         # x would be (len, batch_size, n_d)
         xz = tf.concat(2, [x, tf.expand_dims(z, 2)])
         
+        # batch size is only known at run time
+        batch_size = tf.shape(x)[1]
+        
         # initial state
-        h0 = tf.zeros([1, x.get_shape()[1], self._n_hidden], 
+        h0 = tf.zeros(tf.pack([1, batch_size, self._n_hidden]), 
                        name = 'H_0_matrix_zlayer', 
                        dtype = tf.float32)
         
         # get the zero state for the rlayer
-        h_temp = self.rlayer.zero_state(x.get_shape()[1]) 
+        h_temp = self.rlayer.zero_state(batch_size) 
         
         # ensure that the variables are reused in RCNN
         self.rlayer.reuse = True
@@ -467,8 +781,12 @@ class Z_Layer(object):
         with tf.variable_scope('RNN'):
             
             # here too changed the dynamic rnn to scan
-            htp = tf.scan(self.rlayer, xz, initializer= h_temp)
-            if len(htp.get_shape())>1:
+            htp = scan_rcnn(self.rlayer, xz, h_temp,
+                            precompute = self.precompute,
+                            hidden_only = self.hidden_only)
+            if self.hidden_only:
+                h = htp
+            elif len(htp.get_shape())>1:
             
                 h = htp[:,:, self.rlayer._order * self.rlayer._num_units:]
             else:
@@ -488,12 +806,12 @@ class Z_Layer(object):
         # reshape x such that matmul is possible
         tp1 = tf.reshape(x, [-1, xshape[2]])
         a_tp = tf.matmul(tp1, w1)
-        a = tf.reshape(a_tp, [-1, xshape[1], 1])
+        a = tf.reshape(a_tp, tf.pack([-1, batch_size, 1]))
         
         # reshape h_prev such that matmul is possible
         tp2 = tf.reshape(h_prev, [-1, hshape[2]])
         b_tp = tf.matmul(tp2, w2)
-        b = tf.reshape(b_tp, [-1, hshape[1], 1])
+        b = tf.reshape(b_tp, tf.pack([-1, batch_size, 1]))
         
         # sigmoid it
         logits = a+b+bias
@@ -523,23 +841,34 @@ class Z_Layer(object):
             w2 = tf.get_variable('W2', dtype = tf.float32)
             bias = tf.get_variable('Bias', dtype = tf.float32)
         
+        if self.precompute:
+            # x_t W1 and the rlayer projection of x_t come from sample_all
+            a_t, proj_t = x_t
+        else:
+            a_t = tf.matmul(x_t, w1)
         
-        pz_t = sigmoid(
-                    tf.matmul(x_t, w1) +
-                    tf.matmul(h_tm1[:,-self._n_hidden:], w2) +
-                    bias
-                )
+        logits_t = a_t + tf.matmul(h_tm1[:,-self._n_hidden:], w2) + bias
         
+        pz_t = sigmoid(logits_t)
         
-        pz_t = tf.squeeze(pz_t)
         
-        # predict z
-        z_t = tf.cast(tf.less_equal(tf.random_uniform(pz_t.get_shape(),
-                                                      dtype=tf.float32, seed=seed),
-                                                        pz_t),
-                                                      tf.float32)
+        pz_t = tf.squeeze(pz_t, squeeze_dims = [1])
         
-        xz_t = tf.concat(1,[x_t, tf.reshape(z_t,  [-1,1])])
+        # predict z
+        if self.threshold is not None:
+            # deterministic selection for inference
+            z_t = tf.cast(tf.greater_equal(pz_t, self.threshold), tf.float32)
+        else:
+            z_t = tf.cast(tf.less_equal(tf.random_uniform(tf.shape(pz_t),
+                                                          dtype=tf.float32, seed=seed),
+                                                            pz_t),
+                                                          tf.float32)
+        
+        if self.precompute:
+            # only the z column is left to project
+            xz_t = self.rlayer.add_inputs(proj_t, tf.reshape(z_t, [-1,1]))
+        else:
+            xz_t = tf.concat(1,[x_t, tf.reshape(z_t,  [-1,1])])
         
         # set reuse in rlayer to none
         self.rlayer.reuse = None
@@ -550,9 +879,16 @@ class Z_Layer(object):
         h_t = self.rlayer(h_tm1, xz_t, scope = 'RNN/RCNN_cell_ZLayer',
                           scope2 = 'RNN/RCNN_Feed_Forward_Layer')
         
-        return [h_t , tf.expand_dims(z_t, 1)] 
+        return [h_t , tf.expand_dims(z_t, 1), logits_t] 
     
-    def sample_all(self, x):
+    def sample_all(self, x, return_all = False):
+        '''
+        Sample z for a [len, batch, n_in] sequence.
+        With return_all the sampling pass also gives what forward_all would
+        compute for the sampled z: (z, probs, logits, h) where h are the
+        hidden states of the rlayer. Gradients only flow through the logits,
+        z is a sample and h only feeds the next logits.
+        '''
         
         # get the variables
         with vs.variable_scope('ZLayerWeights', reuse=True) as var_scope:
@@ -560,20 +896,50 @@ class Z_Layer(object):
             w2 = tf.get_variable('W2', dtype = tf.float32)
             bias = tf.get_variable('Bias', dtype = tf.float32)
         
-        h0 = tf.zeros((x.get_shape()[1], self._n_hidden*(self.rlayer._order+1)), dtype = tf.float32)
-        z0 = tf.zeros((x.get_shape()[1],), dtype=tf.float32)
-
-        
-        h, z = tf.scan(
+        batch_size = tf.shape(x)[1]
+        h0 = self.rlayer.zero_state(batch_size)
+        z0 = tf.zeros(tf.pack([batch_size]), dtype=tf.float32)
+        
+        elems = x
+        if self.precompute:
+            # everything that depends on x only is done for the whole
+            # sequence, z is added inside the scan
+            n_in = x.get_shape()[2].value
+            a = tf.reshape(tf.matmul(tf.reshape(x, [-1, n_in]), w1),
+                           tf.pack([-1, batch_size, 1]))
+            
+            self.rlayer.reuse = None
+            proj = self.rlayer.project_inputs(x, n_extra = 1,
+                                              scope = 'RNN/RCNN_cell_ZLayer',
+                                              scope2 = 'RNN/RCNN_Feed_Forward_Layer')
+            elems = (a, proj)
+        
+        elif self.rlayer.fused:
+            # input is [x_t, z_t]
+            self.rlayer.reuse = None
+            self.rlayer.pack_weights(x.get_shape()[2].value + 1,
+                                     scope = 'RNN/RCNN_cell_ZLayer',
+                                     scope2 = 'RNN/RCNN_Feed_Forward_Layer')
+        
+        h, z, logits = tf.scan(
                     self.sample,
-                    x, 
-                    initializer = [ h0, tf.expand_dims(z0, 1 )]
+                    elems, 
+                    initializer = [ h0, tf.expand_dims(z0, 1 ),
+                                    tf.zeros(tf.pack([batch_size, 1]),
+                                             dtype = tf.float32)]
                     )
         
         z = tf.squeeze(z, squeeze_dims = [2])
         assert len(z.get_shape()) == 2
         
-        return z
+        if not return_all:
+            return z
+        
+        logits = tf.squeeze(logits, squeeze_dims = [2])
+        probs = sigmoid(logits)
+        h = h[:, :, self.rlayer._order * self.rlayer._num_units:]
+        
+        return z, probs, logits, h
 
 ###############################
 ####### Extended RCNN #########
@@ -0,0 +1,42 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+atomic_io.py
+Cache files that several processes may write at the same time.
+
+Methods:
+atomic_write:
+    - writes a file under a unique temporary name next to it and renames it
+      into place
+"""
+
+import os
+import tempfile
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def atomic_write(path, write, mode = "wb"):
+    '''
+    Call write(fout) on a temporary file in the directory of path and rename
+    it to path. The temporary name is unique, so concurrent writers of the
+    same path do not clash, and readers see either no file, the old one or a
+    complete new one. An existing path is replaced.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path) or ".",
+                                    prefix = os.path.basename(path) + ".",
+                                    suffix = ".tmp")
+    try:
+        with os.fdopen(fd, mode) as fout:
+            write(fout)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o666 & ~_umask())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
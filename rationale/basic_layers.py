@@ -109,19 +109,34 @@ def _linear(args, output_size, bias, bias_start=0.0, scope=None):
   dtype = [a.dtype for a in args][0]
 
   # Now the computation.
+  matrix, bias_term = _linear_variables(total_arg_size, output_size, bias,
+                                        bias_start, dtype, scope)
+  if len(args) == 1:
+    res = math_ops.matmul(args[0], matrix)
+  else:
+    res = math_ops.matmul(array_ops.concat(1, args), matrix)
+  if not bias:
+    return res
+  return res + bias_term
+
+
+def _linear_variables(total_arg_size, output_size, bias, bias_start=0.0,
+                      dtype=tf.float32, scope=None):
+  """The variables of _linear, without applying them.
+  Returns:
+    (matrix, bias_term) with matrix [total_arg_size x output_size]; bias_term
+    is None when bias is False. Used to precompute the input side of a
+    recurrent cell outside of the scan.
+  """
   with vs.variable_scope(scope or "Linear"):
     matrix = vs.get_variable(
         "Matrix", [total_arg_size, output_size], dtype=dtype, 
         initializer=  tf.random_uniform_initializer(-0.05, 0.05, seed = 2345))
-    if len(args) == 1:
-      res = math_ops.matmul(args[0], matrix)
-    else:
-      res = math_ops.matmul(array_ops.concat(1, args), matrix)
     if not bias:
-      return res
+      return matrix, None
     bias_term = vs.get_variable(
         "Bias", [output_size],
         dtype=dtype,
         initializer=init_ops.constant_initializer(
             bias_start, dtype=dtype))
-  return res + bias_term
\ No newline at end of file
+  return matrix, bias_term
\ No newline at end of file
@@ -0,0 +1,332 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+distributed.py
+Synchronous data-parallel training over worker processes.
+
+Every worker runs the full model on its own shard of the training batches.
+Per step the gradients of all workers are summed and every worker applies
+the same averaged update, so the parameters stay identical. The coordinator
+is a thread of the rank 0 worker (the chief), the workers talk to it over
+TCP (multiprocessing.connection).
+
+When all workers run on the chief's host the arrays do not go through the
+coordinator: every worker writes its array into a shared memory file, sums
+its own segment of the arrays of all workers (reduce-scatter) and then reads
+the summed segments of the others (all-gather). The coordinator only
+provides the two barriers of every round. Otherwise the arrays are sent to
+the coordinator, which sums them in its thread.
+
+Classes:
+AllreduceServer:
+    - the coordinator, barriers and (across hosts) the sums
+AllreduceClient:
+    - weighted mean, sum and broadcast of lists of arrays
+
+Methods:
+free_address:
+    - a free localhost port for the coordinator
+launch_workers:
+    - starts the local worker processes of a run and waits for them
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+
+def authkey():
+    '''
+    Shared secret of the connections, set by launch_workers for local runs.
+    Workers started by hand need the same RATIONALE_AUTHKEY on every host.
+    '''
+    key = os.environ.get("RATIONALE_AUTHKEY")
+    if not key:
+        raise RuntimeError("RATIONALE_AUTHKEY is not set, start the workers "
+                           "with --worker_rank -1 or set it on every host")
+    return key
+
+
+def parse_address(address):
+    '''
+    "host:port" --> (host, port)
+    '''
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def free_address():
+    '''
+    "localhost:port" of a port that is free right now.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("localhost", 0))
+        return "localhost:{}".format(sock.getsockname()[1])
+    finally:
+        sock.close()
+
+
+class AllreduceServer(object):
+    '''
+    Once per round waits for all num_workers clients, sums their weights
+    and, for rounds that carry data, their arrays, and sends the sums back.
+    Runs in a daemon thread.
+    '''
+
+    def __init__(self, address, num_workers):
+        host, port = parse_address(address)
+
+        # other hosts need to reach the chief
+        if host not in ("localhost", "127.0.0.1"):
+            host = ""
+        self.listener = Listener((host, port), authkey = authkey())
+        self.num_workers = num_workers
+
+        # shared memory of the workers on this host
+        shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        self.shm_dir = tempfile.mkdtemp(prefix = "rationale_allreduce_",
+                                        dir = shm)
+
+        self.thread = threading.Thread(target = self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def join(self, timeout = 60):
+        '''
+        Wait until all clients are closed and the shared memory is removed.
+        '''
+        self.thread.join(timeout)
+
+    def _serve(self):
+        conns = [ None ] * self.num_workers
+        local = [ False ] * self.num_workers
+        try:
+            for _ in xrange(self.num_workers):
+                conn = self.listener.accept()
+                rank, hostname = conn.recv()
+                conns[rank] = conn
+                local[rank] = hostname == socket.gethostname()
+
+            # shared memory only if every worker can map it
+            shm_dir = self.shm_dir if all(local) else None
+            for conn in conns:
+                conn.send(shm_dir)
+
+            while True:
+                total, weight = None, 0.0
+                for conn in conns:
+                    header = conn.recv()
+                    if header is None:
+                        # the workers close together
+                        return
+                    w, dtype = header
+                    if dtype is not None:
+                        data = np.frombuffer(conn.recv_bytes(), dtype = dtype)
+                        total = data.copy() if total is None else total + data
+                    weight += w
+
+                for conn in conns:
+                    conn.send(weight)
+                    if total is not None:
+                        conn.send_bytes(total.tobytes())
+        finally:
+            for conn in conns:
+                if conn is not None:
+                    conn.close()
+            self.listener.close()
+            shutil.rmtree(self.shm_dir, ignore_errors = True)
+
+
+class AllreduceClient(object):
+    '''
+    Connection of one worker to the coordinator. All workers have to make
+    the same calls in the same order, with arrays of the same shapes.
+    '''
+
+    def __init__(self, address, rank, num_workers, timeout = 120):
+        self.rank = rank
+        self.num_workers = num_workers
+        self.rounds = 0
+        self._maps = { }
+
+        # the chief may still be starting up
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.conn = Client(parse_address(address), authkey = authkey())
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+
+        self.conn.send((rank, socket.gethostname()))
+        self.shm_dir = self.conn.recv()
+
+    def _barrier(self, weight = 0.0):
+        # total weight of the round, once every worker got here
+        self.conn.send((float(weight), None))
+        return self.conn.recv()
+
+    def barrier(self):
+        '''
+        Wait until every worker called barrier.
+        '''
+        self._barrier()
+
+    def _buffer(self, name, rank, size, dtype):
+        '''
+        Shared memory array of a worker, created by its owner before the
+        barrier after which the others map it. Grown to a power of two so
+        it is rarely remapped.
+        '''
+        capacity = 1 << max(int(size - 1).bit_length(), 10)
+        key = (name, rank, np.dtype(dtype).str)
+        buf = self._maps.get(key)
+        if buf is None or len(buf) < size:
+            path = os.path.join(self.shm_dir, "{}.{}.{}.{}".format(
+                                name, rank, np.dtype(dtype).str.strip("<>|="),
+                                capacity))
+            mode = "w+" if rank == self.rank else "r"
+            buf = np.memmap(path, dtype = dtype, mode = mode,
+                            shape = (capacity,))
+            self._maps[key] = buf
+        return buf
+
+    def _reduce_shared(self, arrays, scale, weight, dtype):
+        n, W = sum(int(np.size(a)) for a in arrays), self.num_workers
+        parity = self.rounds % 2
+        self.rounds += 1
+
+        # segment of the sum this worker computes
+        seg = -(-n // W)
+        lo, hi = min(self.rank * seg, n), min((self.rank + 1) * seg, n)
+
+        # the arrays are copied straight into the shared row
+        row, offset = self._buffer("in", self.rank, n, dtype), 0
+        for a in arrays:
+            size = int(np.size(a))
+            np.multiply(np.ravel(a), scale, out = row[offset:offset+size],
+                        casting = "unsafe")
+            offset += size
+        out = self._buffer("out%d" % parity, self.rank, seg, dtype)
+        total_weight = self._barrier(weight)
+
+        # reduce-scatter, the rows are summed in rank order on every worker
+        acc = np.array(self._buffer("in", 0, n, dtype)[lo:hi])
+        for r in xrange(1, W):
+            acc += self._buffer("in", r, n, dtype)[lo:hi]
+        out[:hi-lo] = acc
+        self._barrier()
+
+        # all-gather; out of the next round is the other parity, so a slow
+        # reader is not overwritten
+        result = np.empty(n, dtype = dtype)
+        for r in xrange(W):
+            a, b = min(r * seg, n), min((r + 1) * seg, n)
+            result[a:b] = self._buffer("out%d" % parity, r, seg, dtype)[:b-a]
+        return result, total_weight
+
+    def _reduce(self, arrays, weight, dtype, scale = 1.0):
+        # sum of the arrays * scale over the workers, and of the weights
+        shapes = [ np.shape(a) for a in arrays ]
+
+        if self.shm_dir is not None:
+            flat, total_weight = self._reduce_shared(arrays, scale, weight,
+                                                     dtype)
+        else:
+            flat = np.concatenate([ np.asarray(a, dtype = dtype).ravel()
+                                    for a in arrays ] + [ np.zeros(0, dtype) ])
+            flat *= scale
+            self.conn.send((float(weight), np.dtype(dtype).str))
+            self.conn.send_bytes(flat.tobytes())
+
+            total_weight = self.conn.recv()
+            flat = np.frombuffer(self.conn.recv_bytes(), dtype = dtype)
+
+        out, offset = [ ], 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            out.append(flat[offset:offset+size].reshape(shape))
+            offset += size
+        return out, total_weight
+
+    def mean(self, arrays, weight, dtype = np.float32):
+        '''
+        Weighted mean over the workers, e.g. gradients weighted by the number
+        of documents of the batch. A worker without data passes weight 0.
+        '''
+        arrays, total = self._reduce(arrays, weight, dtype, scale = weight)
+        return [ a / max(total, 1e-12) for a in arrays ]
+
+    def sum(self, arrays, dtype = np.float64):
+        '''
+        Sum over the workers, e.g. metric totals.
+        '''
+        return self._reduce(arrays, 1.0, dtype)[0]
+
+    def broadcast(self, arrays, root = 0, dtype = np.float32):
+        '''
+        The arrays of worker root on every worker.
+        '''
+        return self.mean(arrays, 1.0 if self.rank == root else 0.0, dtype)
+
+    def close(self):
+        self._maps.clear()
+        self.conn.send(None)
+        self.conn.close()
+
+
+def launch_workers(argv, num_workers, intra_op_threads = 0, coordinator = ""):
+    '''
+    Start num_workers local workers, i.e. this script with argv and
+    --worker_rank 0..num_workers-1, and wait for them. Without explicit
+    thread counts the cores are split between the workers. Without a
+    coordinator address a free local port is used, and a fresh authkey is
+    passed in the environment.
+    Returns the exit code, non-zero if a worker failed.
+    '''
+    extra = [ ]
+    if not intra_op_threads:
+        per_worker = max(multiprocessing.cpu_count() // num_workers, 1)
+        extra += [ "--intra_op_threads", str(per_worker) ]
+    if not coordinator:
+        extra += [ "--coordinator", free_address() ]
+
+    env = dict(os.environ)
+    if not env.get("RATIONALE_AUTHKEY"):
+        env["RATIONALE_AUTHKEY"] = os.urandom(16).encode("hex")
+
+    procs = [ subprocess.Popen([ sys.executable ] + argv + extra +
+                               [ "--worker_rank", str(rank) ], env = env)
+              for rank in xrange(num_workers) ]
+
+    code = 0
+    try:
+        # a failed worker would leave the others waiting in the allreduce
+        while procs:
+            for p in list(procs):
+                ret = p.poll()
+                if ret is None:
+                    continue
+                procs.remove(p)
+                if ret != 0:
+                    code = ret
+                    for q in procs:
+                        q.terminate()
+            time.sleep(1.0)
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+
+    return code
@@ -0,0 +1,362 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+gzip_index.py
+Random access into gzipped corpora.
+
+A sidecar index (<file>.idx.npz) is built once per file. It holds zlib
+restart points, each one is the compressed/uncompressed position of a deflate
+block boundary together with the 32K window of output preceding it, and the
+uncompressed offset of every line. With it a line range [a, b) is read by
+inflating from the nearest restart point instead of from the start of the
+file. This is the approach of zran.c from the zlib examples, the inflate
+calls go through ctypes because the zlib module can not stop at block
+boundaries.
+
+Plain text files get the same index with only the line offsets.
+
+Classes:
+LineIndex:
+    - builds, saves and loads the index, reads byte and line ranges
+load_line_index:
+    - loads the sidecar index of a file, building it if needed
+"""
+
+import ctypes
+import ctypes.util
+import os
+import numpy as np
+from atomic_io import atomic_write
+
+WINSIZE = 32768         # size of the deflate window
+CHUNK = 1 << 16         # size of the compressed reads
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BLOCK = 5
+Z_NO_FLUSH = 0
+
+_zlib = None
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [("next_in", ctypes.c_void_p),
+                ("avail_in", ctypes.c_uint),
+                ("total_in", ctypes.c_ulong),
+                ("next_out", ctypes.c_void_p),
+                ("avail_out", ctypes.c_uint),
+                ("total_out", ctypes.c_ulong),
+                ("msg", ctypes.c_char_p),
+                ("state", ctypes.c_void_p),
+                ("zalloc", ctypes.c_void_p),
+                ("zfree", ctypes.c_void_p),
+                ("opaque", ctypes.c_void_p),
+                ("data_type", ctypes.c_int),
+                ("adler", ctypes.c_ulong),
+                ("reserved", ctypes.c_ulong)]
+
+def _lib():
+    global _zlib
+    if _zlib is None:
+        name = ctypes.util.find_library("z")
+        if name is None:
+            raise IOError("zlib shared library not found")
+        _zlib = ctypes.CDLL(name)
+        _zlib.zlibVersion.restype = ctypes.c_char_p
+    return _zlib
+
+class _Inflater(object):
+    '''
+    Thin wrapper around a zlib inflate stream.
+    window_bits: 47 for automatic gzip/zlib header detection, -15 for raw
+    deflate data.
+    '''
+
+    def __init__(self, window_bits):
+        self.lib = _lib()
+        self.strm = _ZStream()
+        self.window_bits = window_bits
+        ret = self.lib.inflateInit2_(ctypes.byref(self.strm), window_bits,
+                                     self.lib.zlibVersion(),
+                                     ctypes.sizeof(_ZStream))
+        self._check(ret)
+        self.inbuf = ctypes.create_string_buffer(CHUNK)
+
+    def _check(self, ret):
+        if ret not in (Z_OK, Z_STREAM_END):
+            msg = self.strm.msg if self.strm.msg else ""
+            raise IOError("zlib error {}: {}".format(ret, msg))
+
+    def feed(self, data):
+        ctypes.memmove(self.inbuf, data, len(data))
+        self.strm.next_in = ctypes.addressof(self.inbuf)
+        self.strm.avail_in = len(data)
+
+    def inflate(self, outbuf, offset, size, flush):
+        self.strm.next_out = ctypes.addressof(outbuf) + offset
+        self.strm.avail_out = size
+        ret = self.lib.inflate(ctypes.byref(self.strm), flush)
+        if ret == Z_NEED_DICT:
+            raise IOError("zlib error: unexpected dictionary request")
+        # Z_BUF_ERROR (-5) only means no progress was possible
+        if ret != -5:
+            self._check(ret)
+        return ret
+
+    def prime(self, bits, value):
+        self._check(self.lib.inflatePrime(ctypes.byref(self.strm), bits, value))
+
+    def set_dictionary(self, window):
+        self._check(self.lib.inflateSetDictionary(ctypes.byref(self.strm),
+                                                  window, len(window)))
+
+    def reset(self):
+        self._check(self.lib.inflateReset(ctypes.byref(self.strm)))
+
+    def close(self):
+        self.lib.inflateEnd(ctypes.byref(self.strm))
+
+def index_path(path):
+    return path + ".idx.npz"
+
+class LineIndex(object):
+    '''
+        Index of a (gzipped) text file.
+        Inputs
+        ------
+        path            : file that is indexed
+        line_starts     : uncompressed offset of every line, plus the total size
+        points_out      : uncompressed offsets of the restart points
+        points_in       : compressed offsets of the restart points
+        points_bits     : bits of the byte before points_in that belong to the
+                            block, 0 if the block starts on a byte boundary
+        windows         : the 32K of output preceding every restart point
+    '''
+
+    def __init__(self, path, line_starts, points_out = None, points_in = None,
+                 points_bits = None, windows = None):
+        self.path = path
+        self.line_starts = line_starts
+        self.points_out = points_out
+        self.points_in = points_in
+        self.points_bits = points_bits
+        self.windows = windows
+        self.is_gzip = path.endswith(".gz")
+
+    @property
+    def n_lines(self):
+        return len(self.line_starts) - 1
+
+    ###########################
+    ####### Building ##########
+    ###########################
+
+    @classmethod
+    def build(cls, path, span = 1 << 20):
+        '''
+        Build the index with one pass over the file, a restart point is
+        added every span bytes of uncompressed output.
+        '''
+        if not path.endswith(".gz"):
+            newlines = [ ]
+            total = 0
+            with open(path, "rb") as fin:
+                for block in iter(lambda: fin.read(CHUNK), b""):
+                    newlines.append(_newlines(block, total))
+                    total += len(block)
+            return cls(path, _line_starts(newlines, total))
+
+        inflater = _Inflater(47)
+        window = ctypes.create_string_buffer(WINSIZE)
+        points_out, points_in, points_bits, windows = [ ], [ ], [ ], [ ]
+        newlines = [ ]
+        totin = totout = last = 0
+        pos = WINSIZE           # write position in the circular window
+
+        try:
+            with open(path, "rb") as fin:
+                ret = Z_OK
+                while True:
+                    data = fin.read(CHUNK)
+                    if not data:
+                        break
+                    inflater.feed(data)
+
+                    # a full window may leave output pending without input
+                    while inflater.strm.avail_in != 0 or pos == WINSIZE:
+                        if pos == WINSIZE:
+                            pos = 0
+                        avail_in = inflater.strm.avail_in
+                        ret = inflater.inflate(window, pos, WINSIZE - pos, Z_BLOCK)
+                        produced = WINSIZE - pos - inflater.strm.avail_out
+                        totin += avail_in - inflater.strm.avail_in
+
+                        if produced:
+                            newlines.append(_newlines(window.raw[pos:pos+produced], totout))
+                        totout += produced
+                        pos += produced
+
+                        if ret == Z_STREAM_END:
+                            # next member of a multi-member file, if any
+                            inflater.reset()
+                            continue
+
+                        # end of a block header that is not the last block
+                        data_type = inflater.strm.data_type
+                        if (data_type & 128) and not (data_type & 64) and \
+                                (totout == 0 or totout - last > span):
+                            points_out.append(totout)
+                            points_in.append(totin)
+                            points_bits.append(data_type & 7)
+                            windows.append(np.frombuffer(
+                                        window.raw[pos:] + window.raw[:pos],
+                                        dtype = np.uint8))
+                            last = totout
+        finally:
+            inflater.close()
+
+        return cls(path, _line_starts(newlines, totout),
+                   np.array(points_out, dtype = np.int64),
+                   np.array(points_in, dtype = np.int64),
+                   np.array(points_bits, dtype = np.int8),
+                   np.array(windows, dtype = np.uint8).reshape(-1, WINSIZE))
+
+    def save(self, out_path = None):
+        out_path = out_path or index_path(self.path)
+        arrays = {"line_starts": self.line_starts,
+                  "source_size": np.array(os.path.getsize(self.path)),
+                  "source_mtime": np.array(os.path.getmtime(self.path))}
+        if self.is_gzip:
+            arrays.update(points_out = self.points_out,
+                          points_in = self.points_in,
+                          points_bits = self.points_bits,
+                          windows = self.windows)
+
+        # written under a unique temporary name so readers never see half
+        # an index and concurrent builders do not clash
+        atomic_write(out_path, lambda fout: np.savez_compressed(fout, **arrays))
+
+    @classmethod
+    def load(cls, path, in_path = None):
+        arrays = np.load(in_path or index_path(path))
+        # a file rewritten with the same size has a new mtime; indexes
+        # without one are treated as stale
+        if int(arrays["source_size"]) != os.path.getsize(path) or \
+                "source_mtime" not in arrays.files or \
+                float(arrays["source_mtime"]) != os.path.getmtime(path):
+            raise IOError("index of {} is stale".format(path))
+        if path.endswith(".gz"):
+            return cls(path, arrays["line_starts"], arrays["points_out"],
+                       arrays["points_in"], arrays["points_bits"],
+                       arrays["windows"])
+        return cls(path, arrays["line_starts"])
+
+    ###########################
+    ####### Reading ###########
+    ###########################
+
+    def read(self, start, length):
+        '''
+        Read length bytes of uncompressed data starting at offset start.
+        '''
+        if not self.is_gzip:
+            with open(self.path, "rb") as fin:
+                fin.seek(start)
+                return fin.read(length)
+
+        # last restart point at or before start
+        idx = np.searchsorted(self.points_out, start, side = "right") - 1
+        assert idx >= 0, "no restart point before offset {}".format(start)
+
+        inflater = _Inflater(-15)
+        outbuf = ctypes.create_string_buffer(WINSIZE)
+        skip = start - int(self.points_out[idx])
+        chunks = [ ]
+
+        try:
+            with open(self.path, "rb") as fin:
+                bits = int(self.points_bits[idx])
+                fin.seek(int(self.points_in[idx]) - (1 if bits else 0))
+                if bits:
+                    byte = ord(fin.read(1))
+                    inflater.prime(bits, byte >> (8 - bits))
+                inflater.set_dictionary(self.windows[idx].tobytes())
+
+                eof = False
+                while length > 0:
+                    if inflater.strm.avail_in == 0 and not eof:
+                        data = fin.read(CHUNK)
+                        if data:
+                            inflater.feed(data)
+                        else:
+                            eof = True
+
+                    ret = inflater.inflate(outbuf, 0, WINSIZE, Z_NO_FLUSH)
+                    produced = WINSIZE - inflater.strm.avail_out
+
+                    if skip >= produced:
+                        skip -= produced
+                    else:
+                        out = outbuf.raw[skip:produced][:length]
+                        chunks.append(out)
+                        length -= len(out)
+                        skip = 0
+
+                    if ret == Z_STREAM_END:
+                        # continue with the next member, raw inflate leaves
+                        # the 8 byte gzip trailer of the current one unread
+                        rest = ctypes.string_at(inflater.strm.next_in,
+                                                inflater.strm.avail_in)
+                        if inflater.window_bits < 0:
+                            rest += fin.read(max(0, 8 - len(rest)))
+                            rest = rest[8:]
+                        inflater.close()
+                        inflater = _Inflater(47)
+                        if rest:
+                            inflater.feed(rest)
+                    elif produced == 0 and eof:
+                        break
+        finally:
+            inflater.close()
+
+        return b"".join(chunks)
+
+    def read_lines(self, start, stop):
+        '''
+        Lines [start, stop) of the file, newlines included.
+        '''
+        stop = min(stop, self.n_lines)
+        if start >= stop:
+            return [ ]
+        begin = int(self.line_starts[start])
+        end = int(self.line_starts[stop])
+        return self.read(begin, end - begin).splitlines(True)
+
+def _newlines(block, offset):
+    return np.flatnonzero(np.frombuffer(block, dtype = np.uint8) == 10) + offset
+
+def _line_starts(newlines, total):
+    '''
+    Start offset of every line followed by the total size.
+    '''
+    newlines = np.concatenate(newlines) if newlines else np.zeros(0, np.int64)
+    starts = np.concatenate([[0], newlines + 1]).astype(np.int64)
+    if starts[-1] != total:
+        # last line without a trailing newline
+        starts = np.concatenate([starts, [total]])
+    return starts
+
+def load_line_index(path, build = True):
+    '''
+    Sidecar index of a file, built and saved once if it is missing or stale.
+    '''
+    if os.path.exists(index_path(path)):
+        try:
+            return LineIndex.load(path)
+        except IOError:
+            pass
+    if not build:
+        return None
+    index = LineIndex.build(path)
+    index.save()
+    return index
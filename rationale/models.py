@@ -6,13 +6,17 @@ Creates the generator, the encoder and the entire model class
 """
 
 import tensorflow as tf
-from advanced_layers import Z_Layer, RCNNCell, ExtRCNNCell
+from advanced_layers import Z_Layer, RCNNCell, ExtRCNNCell, scan_rcnn, \
+                            scan_bidirectional, compact_selected
 from basic_layers import Layer
 import time
-from optimization_updates import create_optimization_updates
-from IO import create_batches
+from optimization_updates import create_optimization_updates, create_joint_updates, \
+                                 create_feed_updates, create_accumulated_updates
+from IO import create_batches, BatchPrefetcher
+from monitoring import StreamingMetrics, SummaryScheduler
 import numpy as np
 import json
+import hashlib
 import matplotlib 
 import matplotlib.pyplot as plt
 from notification import alert_user
@@ -25,10 +29,13 @@ tf.set_random_seed(2345)
 class Generator(object):
     
     
-    def __init__(self, args, nclasses, embs):
+    def __init__(self, args, nclasses, embs, inference = False):
         self.args = args
         self.nclasses = nclasses
         self.embs = embs
+        
+        # inference graph: deterministic z, no cost functions
+        self.inference = inference
         self.vocab_size, self.embedding_dim = embs.params[0].shape
         print 'Received dictionary of vocab size %s and embedding dim %s.' % \
                     (self.vocab_size, self.embedding_dim)
@@ -38,6 +45,13 @@ class Generator(object):
         self.INIT_DICT = {'rand_uni':tf.random_uniform_initializer(-0.05, 0.05, seed = 2345),
                                  'xavier':tf.contrib.layers.xavier_initializer()}
         
+    def tile_samples(self, t):
+        '''
+        Repeat a [len, batch, ...] tensor n_samples times along the batch
+        axis; sample s of document b is column s*batch + b.
+        '''
+        multiples = [1, self.n_samples] + [1]*(len(t.get_shape()) - 2)
+        return tf.tile(t, tf.pack(multiples))
         
     def ready(self):
         args = self.args
@@ -45,7 +59,8 @@ class Generator(object):
         # inputs for feed dict.
         # x should be a matrix of word Id's, integer valued self.args.max_len
         # embedding placeholder is 
-        self.x = x = tf.placeholder(tf.int64, [None, self.args.max_len], 
+        # x is (length, batch), both dimensions are dynamic
+        self.x = x = tf.placeholder(tf.int64, [None, None], 
                                     name='input_placeholder')  
         self.embedding_placeholder = embedding_placeholder = tf.placeholder(tf.float32, 
                                                                            [self.vocab_size,
@@ -57,16 +72,24 @@ class Generator(object):
         with tf.variable_scope("Generator"):
             
             # create variable for embeddings
-            W = tf.Variable(tf.constant(0.0, 
+            W = self.embedding_var = tf.Variable(tf.constant(0.0, 
                             shape=[self.vocab_size, self.embedding_dim],
                             dtype = tf.float32),
                             trainable=False, name="W")
             
             # assign embeddings, doing this should ensure it is not trainable.
-            embedding_init = W.assign(embedding_placeholder)
+            embedding_init = self.embedding_init = W.assign(embedding_placeholder)
+            
+            # with resident embeddings W is filled once (embedding_init at 
+            # session start or a checkpoint restore) and read directly, 
+            # otherwise the matrix is fed and re-assigned on every run.
+            if args.resident_emb:
+                embeddings = W
+            else:
+                embeddings = embedding_init
             
             # embedding lookup
-            rnn_inputs = self.rnn_inputs =  tf.nn.embedding_lookup(embedding_init,
+            rnn_inputs = self.rnn_inputs =  tf.nn.embedding_lookup(embeddings,
                                                                    x) 
             # set the padding id
             padding_id = self.padding_id = self.embs.vocab_map["<padding>"]
@@ -90,12 +113,13 @@ class Generator(object):
                     self.layers.append(
                         RCNNCell(n_d,
                                  idx = i,
-                                 initializer = initializer
+                                 initializer = initializer,
+                                 fused = args.fused_cell
                                  )
                     )
                     
                     # Create zero states for cells
-                    self.zero_states.append(self.layers[i].zero_state(x.get_shape()[1],
+                    self.zero_states.append(self.layers[i].zero_state(tf.shape(x)[1],
                                                                tf.float32))
                 
                 # masks for removing padding
@@ -114,13 +138,30 @@ class Generator(object):
                 
                 with tf.name_scope('forward_pass_first_layers_generator'):
 
-                    h1tp = tf.scan(self.layers[0], inputs,
-                                   initializer = self.zero_states[0])
-                    
-                    h2tp = tf.scan(self.layers[1], inputs_reversed,
-                                   initializer = self.zero_states[1])
+                    if args.bidirectional_scan:
+                        # both directions in one loop
+                        h1tp, h2tp = scan_bidirectional(self.layers[0],
+                                                        self.layers[1],
+                                                        inputs,
+                                                        self.zero_states[0],
+                                                        self.zero_states[1],
+                                                        precompute = args.precompute_inputs,
+                                                        hidden_only = args.hidden_scan)
+                    else:
+                        h1tp = scan_rcnn(self.layers[0], inputs,
+                                         self.zero_states[0],
+                                         precompute = args.precompute_inputs,
+                                         hidden_only = args.hidden_scan)
+                        
+                        h2tp = scan_rcnn(self.layers[1], inputs_reversed,
+                                         self.zero_states[1],
+                                         precompute = args.precompute_inputs,
+                                         hidden_only = args.hidden_scan)
                     
-                    if len(h1tp.get_shape())>1:
+                    if args.hidden_scan:
+                        # the scans only kept h
+                        h1, h2 = h1tp, h2tp
+                    elif len(h1tp.get_shape())>1:
                         h1 = h1tp[:,:, n_d * args.order:]
                         h2 = h2tp[:,:, n_d * args.order:]
                     else:
@@ -138,48 +179,89 @@ class Generator(object):
                                   lambda: tf.nn.dropout(h_concat, dropout), 
                                   lambda: h_concat, 
                                   name='dropout_firstlayer')
-                                                           
+            
+            # x and the embeddings as seen by the z samples
+            self.n_samples = None
+            self.samples_x = x
+            self.samples_inputs = rnn_inputs
+            
+            if args.num_samples > 1 and not self.inference:
+                # K samples of z per document while training, the first
+                # layers above are run once and their output is tiled
+                self.n_samples = tf.cond(training,
+                                         lambda: tf.constant(args.num_samples),
+                                         lambda: tf.constant(1))
+                h_concat = self.tile_samples(h_concat)
+                h_final = self.tile_samples(h_final)
+                masks = self.tile_samples(masks)
+                self.samples_x = self.tile_samples(x)
+                self.samples_inputs = self.tile_samples(rnn_inputs)
                                                                                                         
             with tf.name_scope('Zlayer') as ns:
                 
                 # creating the output layer
                 self.output_layer = output_layer = Z_Layer(h_final.get_shape()[2], 
-                                                           initializer = initializer)
+                                                           initializer = initializer,
+                                                           precompute = args.precompute_inputs,
+                                                           fused = args.fused_cell,
+                                                           threshold = args.infer_threshold \
+                                                                if self.inference else None,
+                                                           hidden_only = args.hidden_scan)
                 
-                # sample a which words should be kept
-                zpred = output_layer.sample_all(h_final)
+                if self.inference:
+                    # z = pz >= threshold, probs come from the same pass
+                    zpred, probs, _, _ = output_layer.sample_all(h_final,
+                                                                 return_all = True)
+                    self.zpred = zpred
+                    self.probs = tf.reshape(probs, tf.shape(x),
+                                            name = 'probs_reshape')
                 
+                else:
+                    # sample a which words should be kept
+                    if args.single_pass_z:
+                        # the sampling pass also gives the logits, no second
+                        # RCNN pass over (h, z) is needed
+                        zpred, probs, logits, _ = output_layer.sample_all(h_final,
+                                                                          return_all = True)
+                    else:
+                        zpred = output_layer.sample_all(h_final)
                 
-                self.zpredsum = tf.reduce_sum(zpred)
                 
-                # z itself should not be updated
-                zpred = tf.stop_gradient(zpred)
+                    self.zpredsum = tf.reduce_sum(zpred)
+                
+                    # z itself should not be updated
+                    zpred = tf.stop_gradient(zpred)
         
-                # get the probabilities and log loss
-                with tf.name_scope('zlayer_forward_pass'):
-                    probs, logits = output_layer.forward_all(h_concat, zpred)
+                    # get the probabilities and log loss
+                    if not args.single_pass_z:
+                        with tf.name_scope('zlayer_forward_pass'):
+                            probs, logits = output_layer.forward_all(h_concat, zpred)
                 
-                with tf.name_scope('sigmoid_cross_entropy'):
+                    with tf.name_scope('sigmoid_cross_entropy'):
                     
-                    # this error function is the binary cross entropy rewritten
-                    # in terms of softplus, should be more numerically stable
+                        # this error function is the binary cross entropy rewritten
+                        # in terms of softplus, should be more numerically stable
                     
-                    logpz = (-logits*(1-zpred)-tf.nn.softplus(-logits)) * masks
+                        logpz = (-logits*(1-zpred)-tf.nn.softplus(-logits)) * masks
                     
-                logpz = self.logpz = tf.reshape(logpz,tf.shape(x),
-                                                name = 'reshape_logpz')
-                probs = self.probs = tf.reshape(probs, tf.shape(x),
-                                                name = 'probs_reshape')
+                    logpz = self.logpz = tf.reshape(logpz,tf.shape(self.samples_x),
+                                                    name = 'reshape_logpz')
+                    probs = self.probs = tf.reshape(probs, tf.shape(self.samples_x),
+                                                    name = 'probs_reshape')
                 
-                # assign z
-                z = self.zpred = zpred
-                self.ztotsum = tf.reduce_sum(zpred)
+                    # assign z
+                    z = self.zpred = zpred
+                    self.ztotsum = tf.reduce_sum(zpred)
+                    
+                    # the first sample of every document, what is reported
+                    self.z_first = zpred[:, :tf.shape(x)[1]] if self.n_samples \
+                                        is not None else zpred
             
-                # sum z
-                with tf.name_scope('operations_on_z'):
-                    self.zsum = tf.reduce_sum(z, 0, name = 'zsum')
-                    self.zdiff = tf.reduce_sum(tf.abs(z[1:]-z[:-1]),  0,
-                                               name = 'zdiff')
+                    # sum z
+                    with tf.name_scope('operations_on_z'):
+                        self.zsum = tf.reduce_sum(z, 0, name = 'zsum')
+                        self.zdiff = tf.reduce_sum(tf.abs(z[1:]-z[:-1]),  0,
+                                                   name = 'zdiff')
                 
             
             # collect number of trainable params
@@ -198,10 +280,11 @@ class Generator(object):
             
             
             # get l2 cost for all parameters
-            varls = tf.trainable_variables() 
-            lossL2 = tf.add_n([ tf.nn.l2_loss(v) for v in varls
-                         if 'bias' not in v.name ]) * self.args.l2_reg
-            self.L2_loss = lossL2
+            if not self.inference:
+                varls = tf.trainable_variables() 
+                lossL2 = tf.add_n([ tf.nn.l2_loss(v) for v in varls
+                             if 'bias' not in v.name ]) * self.args.l2_reg
+                self.L2_loss = lossL2
 
 
 ###############################
@@ -227,7 +310,7 @@ class Encoder(object):
 
             # variables from the generator
             dropout = gen.dropout
-            x = gen.x
+            x = gen.samples_x
             
             # removed z here. can add back if you want to
             z = tf.expand_dims(gen.zpred, 2)
@@ -235,6 +318,10 @@ class Encoder(object):
             # input placeholder
             y = self.y = tf.placeholder(tf.float32, [None, self.nclasses],
                                         name= 'target_values')
+            
+            # one target per z sample
+            if gen.n_samples is not None:
+                y = tf.tile(y, tf.pack([gen.n_samples, 1]))
 
             n_d = args.hidden_dimension
             n_e = emb_layer.n_d
@@ -256,22 +343,33 @@ class Encoder(object):
                     layers.append(
                                     ExtRCNNCell(n_d,
                                                 idx = 'ExtRCNNCell_%i'%i, 
-                                                initializer = initializer)
+                                                initializer = initializer,
+                                                fused = args.fused_cell)
                                  )
                     zero_states.append(
-                                        layers[i].zero_state(x.get_shape()[1])
+                                        layers[i].zero_state(tf.shape(x)[1])
                                       )
     
     
                 # create layers
-                h_prev = gen.rnn_inputs
+                h_prev = gen.samples_inputs
+                
+                if args.compact_encoder:
+                    # z = 0 steps leave the states untouched, only run the
+                    # layers over the selected words
+                    h_prev, z = compact_selected(h_prev, z)
+                
                 lst_states = []
                 layers_enc = []
                 for idx, layer in enumerate(layers):
                     
-                    h_temp = tf.scan(layer, (h_prev, z), initializer = zero_states[idx])
+                    h_temp = scan_rcnn(layer, h_prev, zero_states[idx], mask = z,
+                                       precompute = args.precompute_inputs,
+                                       hidden_only = args.hidden_scan)
                     
-                    if len(h_temp.get_shape())>1:
+                    if args.hidden_scan:
+                        layers_enc.append(h_temp)
+                    elif len(h_temp.get_shape())>1:
                         layers_enc.append(h_temp[:,:,layer._order*layer._num_units:])
                     else:
                         layers_enc.append(h_temp[:,layer._order*layer._num_units:])
@@ -310,6 +408,11 @@ class Encoder(object):
             with tf.name_scope('output_layer'):
                 preds = self.preds = Layer(h_final, self.nclasses,
                                            initializer = initializer)
+            
+            if gen.inference:
+                # only the predictions are needed
+                print 'Fully Initialized!'
+                return
                 
             
             with tf.name_scope('error_functions_encoder'):
@@ -343,7 +446,26 @@ class Encoder(object):
     
                 # loss function as mentioned in the paper
                 cost_vec = loss_vec + zsum * args.sparsity + zdiff * coherent_factor
-                self.cost_logpz = cost_logpz = tf.reduce_mean(cost_vec * tf.reduce_sum(logpz, 0))
+                
+                if gen.n_samples is not None:
+                    # baseline of every sample: the mean cost of the other
+                    # samples of the same document, only while training
+                    costs = tf.reshape(cost_vec, tf.pack([gen.n_samples, -1]))
+                    k = tf.cast(gen.n_samples, tf.float32)
+                    baseline = (tf.reduce_sum(costs, 0) - costs) / tf.maximum(k - 1, 1.0)
+                    baseline = tf.cond(gen.training,
+                                       lambda: tf.reshape(baseline, [-1]),
+                                       lambda: tf.zeros_like(cost_vec))
+                    reward = cost_vec - tf.stop_gradient(baseline)
+                else:
+                    reward = cost_vec
+                
+                if args.joint_updates:
+                    # the generator cost may only reach the generator, the
+                    # gradients of both costs are taken in one pass
+                    reward = tf.stop_gradient(reward)
+                
+                self.cost_logpz = cost_logpz = tf.reduce_mean(reward * tf.reduce_sum(logpz, 0))
                 self.obj = tf.reduce_mean(cost_vec)
     
                 
@@ -390,18 +512,31 @@ class Encoder(object):
 ###############################
 class Model(object):
 
-    def __init__(self, args, embedding_layer, nclasses):
+    def __init__(self, args, embedding_layer, nclasses, inference = False):
         self.args = args
         self.embedding_layer = embedding_layer
         self.nclasses = nclasses
+        self.inference = inference
         
         self.obj_array = []
         self.prec_array = []
+        
+        # shuffles the order of the training batches every epoch
+        self.batch_rng = np.random.RandomState(5817)
+        
+        # number of training steps, indexes the summaries
+        self.global_step = 0
+        
+        # data-parallel training, see set_distributed
+        self.allreduce = None
+        self.rank = 0
+        self.num_workers = 1
 
 
     def ready(self):
         args, embedding_layer, nclasses = self.args, self.embedding_layer, self.nclasses
-        self.generator = Generator(args, nclasses, embedding_layer)
+        self.generator = Generator(args, nclasses, embedding_layer,
+                                   inference = self.inference)
         self.encoder = Encoder(args, embedding_layer, nclasses, self.generator)
         
         self.generator.ready()
@@ -409,9 +544,213 @@ class Model(object):
         
         self.x = self.generator.x
         self.y = self.encoder.y
-        self.z = self.generator.zpred
+        self.z = self.generator.zpred if self.inference else \
+                    self.generator.z_first
+        self.probs = self.generator.probs
         
     
+    def load_embeddings(self, sess):
+        '''
+        Copy the embedding matrix into the graph once. Only needed with
+        resident embeddings; a checkpoint restore fills it as well.
+        '''
+        if self.args.resident_emb:
+            sess.run(self.generator.embedding_init, 
+                     feed_dict = {self.generator.embedding_placeholder: 
+                                  self.embedding_layer.params[0]})
+    
+    def get_feed_dict(self, bx, by, training = False):
+        '''
+        Feed dict for one batch, the embedding matrix is only added when it 
+        is not resident in the graph.
+        '''
+        args = self.args
+        feed_dict = {self.x: bx,
+                     self.generator.dropout: 1.0 - args.dropout if training else 1.0, 
+                     self.generator.training: training,
+                     self.generator.lr: args.learning_rate}
+        
+        # targets are not needed for predictions
+        if by is not None:
+            feed_dict[self.y] = by
+        
+        if not args.resident_emb:
+            feed_dict[self.generator.embedding_placeholder] = self.embedding_layer.params[0]
+        
+        return feed_dict
+    
+    def set_distributed(self, allreduce):
+        '''
+        Train as one of allreduce.num_workers synchronous workers, see
+        distributed.py. Every worker trains on its own share of the batches,
+        the gradients are averaged before every update.
+        '''
+        self.allreduce = allreduce
+        self.rank = allreduce.rank
+        self.num_workers = allreduce.num_workers
+    
+    @property
+    def is_chief(self):
+        # the worker that evaluates rationales, dumps and saves
+        return self.rank == 0
+    
+    def broadcast_variables(self, sess):
+        '''
+        Give every worker the initial parameters of the chief.
+        '''
+        params = tf.trainable_variables()
+        values = self.allreduce.broadcast(sess.run(params))
+        placeholders = [ tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                         for v in params ]
+        sess.run([ v.assign(p) for v, p in zip(params, placeholders) ],
+                 feed_dict = dict(zip(placeholders, values)))
+    
+    def check_replicas(self, sess):
+        '''
+        Raise on every worker if the parameters of any worker differ from
+        the chief's, compared by a hash of all trainable variables.
+        '''
+        digest = hashlib.md5()
+        for value in sess.run(tf.trainable_variables()):
+            digest.update(np.ascontiguousarray(value).tobytes())
+        local = np.frombuffer(digest.digest(), dtype = np.uint8).astype(np.float32)
+        
+        chief = self.allreduce.broadcast([local])[0]
+        differ = self.allreduce.sum([float(np.any(chief != local))])[0]
+        if differ:
+            raise RuntimeError("parameters of {} worker(s) differ from the chief's"
+                               .format(int(differ)))
+    
+    def distributed_step(self, sess, feed_dict, weight, fetches):
+        '''
+        One synchronous update: the gradients of this worker's batch are
+        averaged with the other workers', weighted by the batch sizes, and 
+        every worker applies the average. A worker without a batch left 
+        (feed_dict None) takes part with weight 0.
+        Returns the values of fetches, computed with the gradients.
+        '''
+        grads, placeholders, apply_op = self.feed_updates
+        
+        if feed_dict is None:
+            local = [ np.zeros(p.get_shape().as_list(), np.float32)
+                      for p in placeholders ]
+            out = None
+        else:
+            out = sess.run(grads + fetches, feed_dict)
+            local, out = out[:len(grads)], out[len(grads):]
+        
+        feed = dict(zip(placeholders, self.allreduce.mean(local, weight)))
+        feed[self.generator.lr] = self.args.learning_rate
+        sess.run(apply_op, feed_dict = feed)
+        
+        return out
+    
+    def prefetch(self, batches_x, batches_y, training = False, order = None,
+                 name = "batches"):
+        '''
+        (bx, by, mask, feed_dict) of the batches in order, prepared ahead by
+        a background thread when --prefetch > 0. For a PaddedBatches this
+        includes padding the batch from the flat ids.
+        '''
+        padding_id = self.embedding_layer.vocab_map["<padding>"]
+        
+        def prepare(i):
+            bx, by = batches_x[i], batches_y[i]
+            return bx, by, bx != padding_id, self.get_feed_dict(bx, by, training)
+        
+        if order is None:
+            order = xrange(len(batches_x))
+        
+        return BatchPrefetcher(order, prepare, self.args.prefetch, name)
+    
+    def synthetic_step(self, sess):
+        '''
+        Fetches and feed dict of one step on a random batch of max_len words,
+        for benchmarking session configurations. A training step is the
+        forward pass and the gradients of both costs.
+        '''
+        args = self.args
+        if self.inference:
+            fetches = [self.z, self.probs, self.encoder.preds]
+        else:
+            grads = tf.gradients(self.encoder.cost_e + self.encoder.cost_g,
+                                 tf.trainable_variables())
+            fetches = [ g for g in grads if g is not None ]
+        
+        sess.run(tf.initialize_all_variables())
+        self.load_embeddings(sess)
+        
+        rng = np.random.RandomState(2345)
+        length = args.max_len if args.max_len > 0 else 256
+        bx = rng.randint(0, self.generator.vocab_size, size = (length, args.batch))
+        by = rng.rand(args.batch, self.nclasses)
+        
+        return fetches, self.get_feed_dict(bx, by, training = not self.inference)
+    
+    def restore(self, sess, path):
+        '''
+        Load the parameters of a saved model.
+        '''
+        sess.run(tf.initialize_all_variables())
+        tf.train.Saver().restore(sess, path)
+        
+        # the vocabulary of this run decides the embedding rows
+        self.load_embeddings(sess)
+        
+    def predict(self, batches_x, sess):
+        '''
+        z, the selection probabilities and the encoder predictions of every
+        batch. Deterministic with an inference model.
+        '''
+        lst = [ ]
+        for _, _, _, feed_dict in self.prefetch(batches_x, [None]*len(batches_x),
+                                                name = "predict"):
+            bz, probs, preds = sess.run([self.z, self.probs, self.encoder.preds],
+                                        feed_dict = feed_dict)
+            lst.append((bz, probs, preds))
+        return lst
+    
+    def loss_vec(self, preds, by):
+        '''
+        Per document loss computed on the host, as encoder.loss_vec. Used by
+        an inference model, which has no cost functions.
+        '''
+        loss_mat = (preds - by)**2
+        if self.args.aspect < 0:
+            return np.mean(loss_mat, 1)
+        return loss_mat[:, self.args.aspect]
+    
+    def run_inference(self, rationale_data, sess):
+        '''
+        Evaluate and dump the rationales of a restored model.
+        '''
+        args = self.args
+        padding_id = self.generator.padding_id
+        
+        start_time = time.time()
+        batches_x, batches_y = create_batches(
+                    [ u["xids"] for u in rationale_data ],
+                    [ u["y"] for u in rationale_data ],
+                    args.batch,
+                    padding_id,
+                    sort = False
+                )
+        
+        r_mse, r_p1, r_prec1, r_prec2 = self.evaluate_rationale(
+                rationale_data, batches_x, batches_y, sess)
+        
+        print ("\trationale mser={:.4f}  p[1]r={:.2f}  prec1={:.4f}" +
+                    "  prec2={:.4f}  [{:.2f}s]\n").format(
+                r_mse,
+                r_p1,
+                r_prec1,
+                r_prec2,
+                time.time()-start_time
+        )
+        
+        if args.dump:
+            self.dump_rationales(args.dump, batches_x, batches_y, sess)
+        
     def train(self, train, dev, test, rationale_data, sess):
         
         '''
@@ -457,38 +796,116 @@ class Model(object):
         
         start_time = time.time()
         
+        # with --prefetch the padded training batches are built per step by
+        # the prefetch thread, otherwise once up front
         train_batches_x, train_batches_y = create_batches(
-                                train[0], train[1], args.batch, padding_id
+                                train[0], train[1], args.batch, padding_id,
+                                lazy = args.prefetch > 0
                             )
         
         print 'Time to create batches: %f.2' % (time.time()-start_time)
         
-        train_step_enc, enorm = create_optimization_updates(self.encoder.cost_e,
-                                                    method= args.learning,
-                                                    beta1 = args.beta1,
-                                                    beta2 = args.beta2,
-                                                    lr = self.generator.lr)
-        
-        train_step_gen, gnorm = create_optimization_updates(self.encoder.cost_g,
-                                                    method= args.learning,
-                                                    beta1 = args.beta1,
-                                                    beta2 = args.beta2,
-                                                    lr = self.generator.lr)
+        # parameters updated by cost_e and cost_g
+        if args.joint_updates:
+            groups = [tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='Encoder'),
+                      tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='Generator')]
+        else:
+            groups = [tf.trainable_variables(), tf.trainable_variables()]
+        
+        self.apply_step = None
+        if args.accumulate_steps > 1:
+            assert self.allreduce is None, "--accumulate_steps is not supported with --num_workers"
+            
+            # the train op only sums the gradients, apply_step updates
+            # every accumulate_steps batches
+            accum_step, self.apply_step = create_accumulated_updates(
+                        [self.encoder.cost_e, self.encoder.cost_g],
+                        groups,
+                        [self.generator.lr, self.generator.lr * args.generator_lr_scale],
+                        method = args.learning,
+                        joint = args.joint_updates,
+                        beta1 = args.beta1,
+                        beta2 = args.beta2)
+            train_ops = [accum_step]
+        elif self.allreduce is not None:
+            assert not args.metrics_period, "--metrics_period is not supported with --num_workers"
+            
+            # gradients are fetched and averaged over the workers, then
+            # applied through placeholders
+            self.feed_updates = create_feed_updates(
+                        [self.encoder.cost_e, self.encoder.cost_g],
+                        groups,
+                        [self.generator.lr, self.generator.lr * args.generator_lr_scale],
+                        method = args.learning,
+                        joint = args.joint_updates,
+                        beta1 = args.beta1,
+                        beta2 = args.beta2)
+            train_ops = [ ]
+        elif args.joint_updates:
+            # one backward pass for both costs, separate optimizers
+            train_step, norms = create_joint_updates(
+                        [self.encoder.cost_e, self.encoder.cost_g],
+                        groups,
+                        [self.generator.lr, self.generator.lr * args.generator_lr_scale],
+                        method = args.learning,
+                        beta1 = args.beta1,
+                        beta2 = args.beta2)
+            train_ops = [train_step]
+        else:
+            train_step_enc, enorm = create_optimization_updates(self.encoder.cost_e,
+                                                        method= args.learning,
+                                                        beta1 = args.beta1,
+                                                        beta2 = args.beta2,
+                                                        lr = self.generator.lr)
+            
+            train_step_gen, gnorm = create_optimization_updates(self.encoder.cost_g,
+                                                        method= args.learning,
+                                                        beta1 = args.beta1,
+                                                        beta2 = args.beta2,
+                                                        lr = self.generator.lr * \
+                                                            args.generator_lr_scale)
+            train_ops = [train_step_enc, train_step_gen]
         le, lg, tle, tlg, l2e, l2g, obj_loss = self.encoder.le, self.encoder.lg, \
                                         self.encoder.tle, self.encoder.tlg, \
                                         self.encoder.l2e, self.encoder.l2g, \
                                         self.encoder.obj_loss
         
-        self.merged = merged = tf.merge_summary([le, lg, tle, tlg, l2e, l2g, obj_loss])
+        scalars = [le, lg, tle, tlg, l2e, l2g, obj_loss]
+        self.merged = merged = tf.merge_summary(scalars)
+        
+        if args.metrics_period:
+            # per step metrics are summed in the graph and read every 
+            # metrics_period steps instead of fetching z every step
+            gen = self.generator
+            self.metrics = StreamingMetrics([
+                    ('cost', self.encoder.obj),
+                    ('loss', self.encoder.loss),
+                    ('sparsity', self.encoder.sparsity_cost),
+                    ('diff', self.encoder.pred_diff),
+                    ('p1', tf.reduce_sum(self.z * gen.masks) / \
+                                (tf.reduce_sum(gen.masks) + 1e-8))])
         
         init = tf.initialize_all_variables()
         
-        train_writer = tf.train.SummaryWriter( 'train', sess.graph)
-        eval_writer = tf.train.SummaryWriter( 'eval', sess.graph)
+        # only the chief writes summaries
+        train_writer, eval_writer = None, None
+        if self.is_chief:
+            train_writer = tf.train.SummaryWriter( 'train', sess.graph)
+            eval_writer = tf.train.SummaryWriter( 'eval', sess.graph)
+        
+        # summaries only run on logging steps
+        self.summaries = SummaryScheduler(train_writer, scalars,
+                                          args.summary_every if self.is_chief else 0,
+                                          args.histogram_every if self.is_chief else 0)
         
         saver = tf.train.Saver()
         
         sess.run(init)
+        sess.run(tf.initialize_local_variables())
+        self.load_embeddings(sess)
+        
+        if self.allreduce is not None:
+            self.broadcast_variables(sess)
         
         
         # Training Loop
@@ -501,17 +918,16 @@ class Model(object):
             
             unchanged += 1
             if unchanged > 20: 
-                self.plot()
+                if self.is_chief:
+                    self.plot()
                 
-                if self.args.email:
+                if self.args.email and self.is_chief:
                     self.notify_user_success()
                 
                 return
             
-            # Create new batches
-            train_batches_x, train_batches_y = create_batches(
-                            train[0], train[1], args.batch, padding_id
-                        )
+            # batches are built once, only their order changes per epoch
+            batch_order = self.batch_rng.permutation(len(train_batches_x))
 
             more = True
             
@@ -526,42 +942,68 @@ class Model(object):
                 start_time = time.time()
                 
                 N = len(train_batches_x)
-                for i in xrange(N):
+                
+                # every worker takes every num_workers-th batch
+                order = batch_order[self.rank::self.num_workers]
+                batches = self.prefetch(train_batches_x, train_batches_y,
+                                        training = True, order = order,
+                                        name = "train")
+                
+                if args.metrics_period:
+                    sess.run(self.metrics.reset)
+                
+                def apply_accumulated(i):
+                    # one update per accumulate_steps batches, and the rest
+                    # at the end of the epoch
+                    if self.apply_step is not None and \
+                            ((i+1) % args.accumulate_steps == 0 or i+1 == len(order)):
+                        sess.run(self.apply_step, 
+                                 {self.generator.lr: args.learning_rate})
+                    
+                for i, (bx, by, mask, feed_dict) in enumerate(batches):
                     
                     # notify user for elapsed time
-                    if (i+1)%50 == 0:
-                        print "\r{}/{} {:.5f}       ".format(i+1,N,p1/(i+1))
+                    if (i+1)%(args.metrics_period or 50) == 0:
+                        if args.metrics_period:
+                            p1 = self.metrics.read(sess)['p1']
+                        print "\r{}/{} {:.5f}       ".format(i+1,len(order),p1/(i+1))
                         
-                        if self.args.email and p1/(i+1) > 0.4 and epoch > 10:
+                        # (only single process, the workers have to stop together)
+                        if self.args.email and p1/(i+1) > 0.4 and epoch > 10 and \
+                                self.allreduce is None:
                             self.plot()
                             self.notify_user_failure()
                             return 
                         
-                    # training batches for this round
-                    bx, by = train_batches_x[i], train_batches_y[i]
+                    # training batches for this round come prepared
+                    step_summaries = self.summaries.fetches(self.global_step)
                     
-                    mask = (bx != padding_id)
-                    
-                    if bx.shape[1] != 256:
-                        bx = bx.T
+                    if args.metrics_period:
+                        # only the updates and the scheduled summaries
+                        out = sess.run(train_ops + [self.metrics.update] +
+                                       step_summaries, feed_dict)
+                        self.summaries.write(out[len(train_ops)+1:],
+                                             self.global_step)
+                        self.global_step += 1
+                        apply_accumulated(i)
                         continue
                     
-    
+                    fetches = [self.encoder.obj,
+                               self.encoder.loss,
+                               self.encoder.sparsity_cost,
+                               self.z, self.generator.ztotsum] + step_summaries
                     
-                    feed_dict = {self.x: bx,
-                                 self.y : by, 
-                                 self.generator.embedding_placeholder: self.embedding_layer.params[0], 
-                                 self.generator.dropout:1.0 -  args.dropout, 
-                                 self.generator.training: True,
-                                 self.generator.lr: self.args.learning_rate}
-                                 
                     # training forward pass
-                    _,_,  cost, loss, sparsity_cost, bz, summary, ztotsum  = sess.run([train_step_enc, train_step_gen,
-                                                self.encoder.obj,
-                                                self.encoder.loss,
-                                                self.encoder.sparsity_cost,
-                                                self.z, merged, self.generator.ztotsum], 
-                                                feed_dict)
+                    if self.allreduce is not None:
+                        out = self.distributed_step(sess, feed_dict, len(by),
+                                                    fetches)
+                    else:
+                        out = sess.run(train_ops + fetches,
+                                       feed_dict)[len(train_ops):]
+                    apply_accumulated(i)
+                    cost, loss, sparsity_cost, bz, ztotsum = out[:5]
+                    self.summaries.write(out[5:], self.global_step)
+                    self.global_step += 1
 
                     k = len(by)
                     processed += k
@@ -577,7 +1019,24 @@ class Model(object):
                     
                     
                     
-                train_writer.add_summary(summary, epoch)
+                if args.metrics_period:
+                    totals = self.metrics.read(sess)
+                    train_cost, train_loss = totals['cost'], totals['loss']
+                    train_sparsity_cost, p1 = totals['sparsity'], totals['p1']
+                
+                if self.allreduce is not None:
+                    # all workers make the same number of updates
+                    n_steps = -(-N // self.num_workers)
+                    for _ in xrange(n_steps - len(order)):
+                        self.distributed_step(sess, None, 0, [ ])
+                    
+                    # totals over all batches
+                    train_cost, train_loss, train_sparsity_cost, p1 = [ float(v)
+                        for v in self.allreduce.sum([train_cost, train_loss,
+                                                     train_sparsity_cost, p1]) ]
+                    
+                    # the workers have to stay in sync
+                    self.check_replicas(sess)
                     
              
                 cur_train_avg_cost = train_cost/N
@@ -614,17 +1073,23 @@ class Model(object):
                 last_train_avg_cost = cur_train_avg_cost
                 if dev: last_dev_avg_cost = cur_dev_avg_cost
                 
+                # the whole shard has run here; it may be empty with more
+                # workers than batches, so the batch counter i is not used
+                elapsed = (time.time()-start_time)/60.0
                 print '\n'
                 print  ("Generator Epoch {:.2f}  costg={:.4f}  scost={:.4f}  lossg={:.4f}  " +
                     "p[1]={:.2f} \t[{:.2f}m / {:.2f}m]\n").format(
-                        epoch+(i+1.0)/N,
+                        epoch+1.0,
                         train_cost / N,
                         train_sparsity_cost / N,
                         train_loss / N,
                         p1 / N,
-                        (time.time()-start_time)/60.0,
-                        (time.time()-start_time)/60.0/(i+1)*N
+                        elapsed,
+                        elapsed
                     )
+                
+                if args.prefetch:
+                    print '\t' + batches.report()
 
                 self.obj_array.append(train_loss / N)
                     
@@ -632,13 +1097,13 @@ class Model(object):
                     if dev_obj < best_dev:
                         best_dev = dev_obj
                         unchanged = 0
-                        if args.dump and rationale_data:
+                        if args.dump and rationale_data and self.is_chief:
                             
                             # implement dump rationales
                             self.dump_rationales(args.dump, valid_batches_x, valid_batches_y,
                                         sess)
 
-                        if args.save_model:
+                        if args.save_model and self.is_chief:
                             
                             print 'Saving Model: dev_obj @ {:.4f}'.format(dev_obj)
                             saver.save(sess, args.save_model.format(dev_obj))
@@ -652,7 +1117,7 @@ class Model(object):
                         best_dev
                     )
 
-                    if rationale_data is not None:
+                    if rationale_data is not None and self.is_chief:
                         r_mse, r_p1, r_prec1, r_prec2 = self.evaluate_rationale(
                                 rationale_data, valid_batches_x,
                                 valid_batches_y, sess)
@@ -723,40 +1188,60 @@ class Model(object):
                     
     def evaluate_data(self, batches_x, batches_y, sess, epoch, merged, eval_writer):
             
-        padding_id = self.embedding_layer.vocab_map["<padding>"]
         tot_obj, tot_mse, tot_diff, p1 = 0.0, 0.0, 0.0, 0.0
-        for bx, by in zip(batches_x, batches_y):
+        
+        # the workers evaluate a share of the batches each
+        batches_x = batches_x[self.rank::self.num_workers]
+        batches_y = batches_y[self.rank::self.num_workers]
+        
+        batches = self.prefetch(batches_x, batches_y, name = "dev")
+        n = len(batches_x)
+        
+        # the summary of the last batch is written, at the current step
+        def summary_ops(i):
+            return [merged] if i == n-1 and self.args.summary_every and \
+                                self.is_chief else [ ]
+        
+        def write_summary(out):
+            if out:
+                eval_writer.add_summary(out[0], self.global_step)
+        
+        if self.args.metrics_period:
+            # accumulate in the graph
+            sess.run(self.metrics.reset)
+            for i, (bx, by, mask, feed_dict) in enumerate(batches):
+                out = sess.run([self.metrics.update] + summary_ops(i),
+                               feed_dict = feed_dict)
+                write_summary(out[1:])
             
-            if bx.shape[1] != 256:
-                print 'shape of eval x: ', bx.shape
-                continue 
+            if self.args.prefetch:
+                print '\t' + batches.report()
             
-            feed_dict = {
-                         self.x: bx,
-                         self.y: by, 
-                         self.generator.embedding_placeholder: self.embedding_layer.params[0], 
-                         self.generator.dropout:1.0, 
-                         self.generator.training:False, 
-                         self.generator.lr:self.args.learning_rate
-                         }
-               
-            mask = (bx != padding_id)
+            m = self.metrics.means(sess)
+            return m['cost'], m['loss'], m['diff'], m['p1']
+        
+        for i, (bx, by, mask, feed_dict) in enumerate(batches):
             
             
-            bz, o, e, d, summary = sess.run([self.z, self.encoder.obj,
-                                    self.encoder.loss, self.encoder.pred_diff,
-                                    merged],
-                                    feed_dict = feed_dict)
+            out = sess.run([self.z, self.encoder.obj,
+                            self.encoder.loss, self.encoder.pred_diff] + 
+                            summary_ops(i),
+                            feed_dict = feed_dict)
+            bz, o, e, d = out[:4]
+            write_summary(out[4:])
             
             p1 += np.sum(bz*mask) / (np.sum(mask) + 1e-8)
             tot_obj += o
             tot_mse += e
             tot_diff += d
-            
-        eval_writer.add_summary(summary, epoch)
-
         
-        n = len(batches_x)
+        if self.args.prefetch:
+            print '\t' + batches.report()
+        
+        if self.allreduce is not None:
+            tot_obj, tot_mse, tot_diff, p1, n = [ float(v) for v in 
+                    self.allreduce.sum([tot_obj, tot_mse, tot_diff, p1, n]) ]
+        
         return tot_obj/n, tot_mse/n, tot_diff/n, p1/n
         
     
@@ -766,24 +1251,18 @@ class Model(object):
         embedding_layer = self.embedding_layer
 
         lst = [ ]
-        for bx, by in zip(batches_x, batches_y):
-            if bx.shape[1] != 256:
-                print 'dev shape of x: ', bx.shape
-                continue 
-            
-            feed_dict = {
-                         self.x: bx,
-                         self.y : by, 
-                         self.generator.embedding_placeholder: self.embedding_layer.params[0], 
-                         self.generator.dropout:1.0,
-                         self.generator.training: False,
-                         self.generator.lr: self.args.learning_rate
-                         }
-                
-            loss_vec_r, preds_r, bz = sess.run([ self.encoder.loss_vec, 
-                                                self.encoder.preds,
-                                                self.z ], 
-                                                feed_dict = feed_dict)
+        for bx, by, _, feed_dict in self.prefetch(batches_x, batches_y,
+                                                  name = "dump"):
+            
+            if self.inference:
+                preds_r, bz = sess.run([ self.encoder.preds, self.z ],
+                                       feed_dict = feed_dict)
+                loss_vec_r = self.loss_vec(preds_r, by)
+            else:
+                loss_vec_r, preds_r, bz = sess.run([ self.encoder.loss_vec, 
+                                                    self.encoder.preds,
+                                                    self.z ], 
+                                                    feed_dict = feed_dict)
             
             
             assert len(loss_vec_r) == bx.shape[1]
@@ -817,27 +1296,17 @@ class Model(object):
         p1, tot_mse, tot_prec1, tot_prec2 = 0.0, 0.0, 0.0, 0.0
         tot_z, tot_n = 1e-10, 1e-10
         cnt = 0
-        for bx, by in zip(batches_x, batches_y):
-            mask = bx != padding_id
-            
-            if bx.shape[1] != 256:
-                print '\tSkipping tensor, size mismatch: ', bx.shape
-                continue 
-            
-            feed_dict = {
-                         self.x: bx,
-                         self.y : by, 
-                         self.generator.embedding_placeholder: self.embedding_layer.params[0], 
-                         self.generator.dropout:1.0, 
-                         self.generator.training: False, 
-                         self.generator.lr: self.args.learning_rate
-                         }
-                         
-                         
-            
-            bz, o, e, d = sess.run([self.z, self.encoder.obj,
-                                    self.encoder.loss, self.encoder.pred_diff],
-                                    feed_dict = feed_dict)
+        batches = self.prefetch(batches_x, batches_y, name = "rationale")
+        for bx, by, mask, feed_dict in batches:
+            
+            if self.inference:
+                bz, preds = sess.run([self.z, self.encoder.preds],
+                                     feed_dict = feed_dict)
+                e = np.mean(self.loss_vec(preds, by))
+            else:
+                bz, o, e, d = sess.run([self.z, self.encoder.obj,
+                                        self.encoder.loss, self.encoder.pred_diff],
+                                        feed_dict = feed_dict)
             
            
             tot_mse += e
@@ -860,6 +1329,9 @@ class Model(object):
                     tot_z += nz
                     cnt += 1
 
+        if args.prefetch:
+            print '\t' + batches.report()
+        
         n = len(batches_x)
         return tot_mse/n, p1/n, tot_prec1/tot_n, tot_prec2/tot_z
         
@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+monitoring.py
+Training metrics that stay in the graph.
+
+Classes:
+StreamingMetrics:
+    - running sums of per step scalars in local variables, with update,
+      reset and read ops, so the step ops do not fetch z or the costs to
+      the host every step
+SummaryScheduler:
+    - runs the scalar and histogram summaries only every so many steps
+"""
+
+from collections import OrderedDict
+import tensorflow as tf
+
+
+class StreamingMetrics(object):
+    '''
+    In-graph running sums of scalar tensors.
+    Inputs
+    ------
+        values          : list of (name, scalar tensor) pairs, evaluated and
+                          added to the sums by every run of update
+        name            : variable scope of the accumulators
+    '''
+
+    def __init__(self, values, name = 'streaming_metrics'):
+        self.names = [ k for k, _ in values ]
+
+        with tf.variable_scope(name):
+            # local variables, not saved in checkpoints and not trained
+            self.totals = OrderedDict(
+                    (k, tf.Variable(0.0, trainable = False, name = k,
+                                    collections = [tf.GraphKeys.LOCAL_VARIABLES]))
+                    for k in self.names)
+            self.count = tf.Variable(0.0, trainable = False, name = 'count',
+                                     collections = [tf.GraphKeys.LOCAL_VARIABLES])
+
+        self.update = tf.group(*([ self.totals[k].assign_add(tf.cast(v, tf.float32))
+                                   for k, v in values ] +
+                                 [ self.count.assign_add(1.0) ]))
+
+        self.reset = tf.initialize_variables(list(self.totals.values()) +
+                                             [ self.count ])
+
+    def read(self, sess):
+        '''
+        Sums since the last reset and the number of updates, as a dict.
+        '''
+        values = sess.run(list(self.totals.values()) + [ self.count ])
+        totals = dict(zip(self.names, values[:-1]))
+        totals['count'] = int(values[-1])
+        return totals
+
+    def means(self, sess):
+        '''
+        Averages per update since the last reset.
+        '''
+        totals = self.read(sess)
+        n = max(totals.pop('count'), 1)
+        return dict((k, v / n) for k, v in totals.items())
+
+
+class SummaryScheduler(object):
+    '''
+    Decides on which steps summaries are computed, so steps in between run
+    no summary ops at all, and writes them indexed by the global step.
+    Inputs
+    ------
+        writer          : tf.train.SummaryWriter
+        scalars         : scalar summary ops
+        scalar_every    : steps between scalar summaries, 0 for none
+        histogram_every : steps between histogram summaries, 0 for none. The
+                          histograms are all other summaries of the graph
+                          (e.g. the weights of basic_layers.Layer).
+    '''
+
+    def __init__(self, writer, scalars, scalar_every = 100,
+                 histogram_every = 0):
+        self.writer = writer
+        self.scalar_every = scalar_every
+        self.histogram_every = histogram_every
+
+        histograms = [ s for s in tf.get_collection(tf.GraphKeys.SUMMARIES)
+                       if s not in scalars ]
+
+        self.scalar_op = tf.merge_summary(scalars) if scalars else None
+        self.histogram_op = tf.merge_summary(histograms) if histograms else None
+
+    def fetches(self, step):
+        '''
+        Summary ops to add to the run of this step, empty on steps that are
+        not logged.
+        '''
+        ops = [ ]
+        if self.scalar_op is not None and self.scalar_every and \
+                step % self.scalar_every == 0:
+            ops.append(self.scalar_op)
+        if self.histogram_op is not None and self.histogram_every and \
+                step % self.histogram_every == 0:
+            ops.append(self.histogram_op)
+        return ops
+
+    def write(self, values, step):
+        '''
+        Write the fetched values of fetches(step).
+        '''
+        for value in values:
+            self.writer.add_summary(value, step)
@@ -9,6 +9,25 @@ Author Riaan
 import tensorflow as tf
 
 
+def create_optimizer(method = 'sgd', lr = 0.01, eps = None, rho = 0.99,
+                     beta1 = 0.9, beta2 = 0.999):
+    '''
+    The tf.train optimizer for a method name.
+    '''
+    if method == 'sgd':
+        return tf.train.GradientDescentOptimizer(learning_rate = lr)
+    elif method == 'adadelta':
+        return tf.train.AdadeltaOptimizer(learning_rate = lr, rho = rho)
+    elif method == 'adagrad':
+        return tf.train.AdagradOptimizer(learning_rate = lr)
+    elif method =='adam':
+        return tf.train.AdamOptimizer(learning_rate = lr,
+                                      beta1 = beta1,
+                                      beta2= beta2)
+    
+    raise ValueError("unknown optimization method: {}".format(method))
+
+
 def create_optimization_updates(cost, params = None, method = 'sgd',
                                 max_norm = 5,
                                 updates = None, gradients = None,
@@ -16,23 +35,163 @@ def create_optimization_updates(cost, params = None, method = 'sgd',
                                 gamma = 0.999, beta1 = 0.9,
                                 beta2= 0.999, momentum = 0.0):
     
-    if method == 'sgd':
-        opt = tf.train.GradientDescentOptimizer(learning_rate = lr).minimize(cost)
-        gnorms = None
-    elif method == 'adadelta':
-        opt = tf.train.AdadeltaOptimizer(learning_rate = lr, rho = rho).mimimze(cost)
-        gnorms = None
-    elif method == 'adagrad':
-        opt = tf.train.AdagradOptimizer(learning_rate = lr).minimize(cost)
-        gnorms = None
-    elif method =='adam':
-        opt_uncl = tf.train.AdamOptimizer(learning_rate = lr,
-                                         beta1 = beta1,
-                                         beta2= beta2).minimize(cost)
+    opt = create_optimizer(method, lr = lr, eps = eps, rho = rho,
+                           beta1 = beta1, beta2 = beta2).minimize(cost)
+    gnorms = None
+    
+    return opt, gnorms
+
+
+def create_joint_updates(costs, param_groups, lrs, method = 'sgd',
+                         eps = None, rho = 0.99, beta1 = 0.9, beta2 = 0.999):
+    '''
+    Update several parameter groups, each with its own optimizer and learning
+    rate, from a single backward pass.
+    costs           : one cost per group, the gradient of cost i may only
+                      reach group i (use stop_gradient), since the
+                      gradients of their sum are split per group
+    param_groups    : lists of variables
+    lrs             : learning rate of every group
+    Returns the grouped update op and the gradient norm of every group.
+    '''
+    params = [v for group in param_groups for v in group]
+    
+    # one tf.gradients call, the scans are backpropagated once
+    grads = tf.gradients(tf.add_n(costs), params)
+    
+    ops, gnorms = [ ], [ ]
+    offset = 0
+    for group, lr in zip(param_groups, lrs):
+        pairs = [ (g, v) for g, v in zip(grads[offset:offset+len(group)], group)
+                  if g is not None ]
+        offset += len(group)
         
-        opt = opt_uncl
-        gnorms = None
+        opt = create_optimizer(method, lr = lr, eps = eps, rho = rho,
+                               beta1 = beta1, beta2 = beta2)
+        ops.append(opt.apply_gradients(pairs))
+        gnorms.append(tf.global_norm([ g for g, _ in pairs ]))
+    
+    return tf.group(*ops), gnorms
+
+
+def _group_gradients(costs, param_groups, joint = False):
+    '''
+    Gradients of every group: of the sum of the costs with joint (one
+    backward pass, see create_joint_updates), otherwise of cost i w.r.t.
+    group i.
+    '''
+    if joint:
+        params = [v for group in param_groups for v in group]
+        flat = tf.gradients(tf.add_n(costs), params)
+        group_grads, offset = [ ], 0
+        for group in param_groups:
+            group_grads.append(flat[offset:offset+len(group)])
+            offset += len(group)
+        return group_grads
+    
+    return [ tf.gradients(cost, group)
+             for cost, group in zip(costs, param_groups) ]
+
+
+def _apply_in_order(optimizers, group_pairs):
+    '''
+    apply_gradients of every group, each one after the previous. The groups
+    of the separate updates share their variables, in one tf.group their
+    order would be arbitrary and could differ between runs and workers.
+    Only the gradients wait for the previous update, so the slots of the
+    optimizers are not created under a control dependency.
+    '''
+    ops = [ ]
+    for opt, pairs in zip(optimizers, group_pairs):
+        if ops:
+            with tf.control_dependencies(ops[-1:]):
+                pairs = [ (tf.identity(g), v) for g, v in pairs ]
+        ops.append(opt.apply_gradients(pairs))
+    return ops
+
+
+def create_feed_updates(costs, param_groups, lrs, method = 'sgd',
+                        joint = False, eps = None, rho = 0.99, beta1 = 0.9,
+                        beta2 = 0.999):
+    '''
+    Updates whose gradients are computed in one run and applied in another,
+    fed back through placeholders. In between they can be averaged over
+    workers (see distributed.py).
+    joint           : one tf.gradients over the sum of the costs, split per
+                      group as in create_joint_updates. Otherwise every cost
+                      is differentiated w.r.t. its own group, as the separate
+                      minimize ops of create_optimization_updates do.
+    Returns the gradient tensors, their placeholders and the apply op, which
+    updates the groups one after the other.
+    Variables without a gradient are left out.
+    '''
+    group_grads = _group_gradients(costs, param_groups, joint)
+    
+    grads, placeholders, optimizers, group_pairs = [ ], [ ], [ ], [ ]
+    for group, gs, lr in zip(param_groups, group_grads, lrs):
+        pairs = [ ]
+        for g, v in zip(gs, group):
+            if g is None:
+                continue
+            p = tf.placeholder(v.dtype.base_dtype, v.get_shape())
+            grads.append(tf.convert_to_tensor(g))
+            placeholders.append(p)
+            pairs.append((p, v))
+        
+        optimizers.append(create_optimizer(method, lr = lr, eps = eps, rho = rho,
+                                           beta1 = beta1, beta2 = beta2))
+        group_pairs.append(pairs)
+    
+    ops = _apply_in_order(optimizers, group_pairs)
+    return grads, placeholders, tf.group(*ops)
+
 
+def create_accumulated_updates(costs, param_groups, lrs, method = 'sgd',
+                               joint = False, eps = None, rho = 0.99,
+                               beta1 = 0.9, beta2 = 0.999):
+    '''
+    Gradient accumulation: the gradients of several micro-batches are summed
+    in variables and applied as their mean in one optimizer step, so the
+    effective batch grows without the activations of a larger batch.
+    joint           : as in create_feed_updates
+    Returns the accumulate op, run once per micro-batch, and the apply op,
+    which updates the parameters and zeroes the sums.
+    The sums are local variables, initialized by initialize_local_variables.
+    '''
+    group_grads = _group_gradients(costs, param_groups, joint)
+    
+    count = tf.Variable(0.0, trainable = False, name = 'accum_count',
+                        collections = [tf.GraphKeys.LOCAL_VARIABLES])
+    
+    accum_ops, sums = [ count.assign_add(1.0) ], [ count ]
+    optimizers, group_pairs = [ ], [ ]
+    for group, gs, lr in zip(param_groups, group_grads, lrs):
+        pairs = [ ]
+        for g, v in zip(gs, group):
+            if g is None:
+                continue
+            acc = tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                              trainable = False,
+                              name = v.op.name.replace('/', '_') + '_accum',
+                              collections = [tf.GraphKeys.LOCAL_VARIABLES])
+            
+            if isinstance(g, tf.IndexedSlices):
+                # sparse gradient of an embedding lookup, only touched rows
+                accum_ops.append(tf.scatter_add(acc, g.indices, g.values))
+            else:
+                accum_ops.append(acc.assign_add(g))
+            
+            sums.append(acc)
+            pairs.append((acc / tf.maximum(count, 1.0), v))
         
+        optimizers.append(create_optimizer(method, lr = lr, eps = eps, rho = rho,
+                                           beta1 = beta1, beta2 = beta2))
+        group_pairs.append(pairs)
+    
+    apply_ops = _apply_in_order(optimizers, group_pairs)
+    
+    # the sums are zeroed after the optimizers have read them
+    with tf.control_dependencies(apply_ops):
+        apply_op = tf.group(*[ acc.assign(tf.zeros_like(acc)) for acc in sums ])
     
-    return opt, gnorms
\ No newline at end of file
+    return tf.group(*accum_ops), apply_op
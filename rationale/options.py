@@ -21,6 +21,26 @@ def load_arguments():
             default = "data/review+wiki.filtered.200.txt.gz",
             help = "path to pre-trained word vectors"
         )
+    argparser.add_argument("--embedding_store",
+            type = int,
+            default = 1,
+            help = "convert the embeddings once into a memory-mapped binary store"
+        )
+    argparser.add_argument("--embedding_dtype",
+            type = str,
+            default = "float32",
+            help = "dtype of the binary embedding store: float32 or float16"
+        )
+    argparser.add_argument("--prune_vocab",
+            type = int,
+            default = 0,
+            help = "only keep the embeddings of words in the train, dev and rationale data"
+        )
+    argparser.add_argument("--workers",
+            type = int,
+            default = 1,
+            help = "number of processes used to parse the data and embedding files"
+        )
     argparser.add_argument("--save_model",
             type = str,
             default = "data/saves/best_model_{:.4f}.ckpt",
@@ -31,11 +51,86 @@ def load_arguments():
             default = "",
             help = "path to load model"
         )
+    argparser.add_argument("--prefetch",
+            type = int,
+            default = 0,
+            help = "number of batches prepared ahead by a background thread, 0 to prepare them in the loop"
+        )
+    argparser.add_argument("--metrics_period",
+            type = int,
+            default = 0,
+            help = "accumulate the training metrics in the graph and read them every this many steps, 0 to fetch them every step"
+        )
+    argparser.add_argument("--summary_every",
+            type = int,
+            default = 100,
+            help = "training steps between scalar summaries, 0 for none"
+        )
+    argparser.add_argument("--histogram_every",
+            type = int,
+            default = 0,
+            help = "training steps between histogram summaries, 0 for none"
+        )
+    argparser.add_argument("--intra_op_threads",
+            type = int,
+            default = 0,
+            help = "threads used within one op, 0 for the tensorflow default"
+        )
+    argparser.add_argument("--inter_op_threads",
+            type = int,
+            default = 0,
+            help = "ops run concurrently, 0 for the tensorflow default"
+        )
+    argparser.add_argument("--cpu_affinity",
+            type = str,
+            default = "",
+            help = "cpus to pin the process to, e.g. 0-15,32-47"
+        )
+    argparser.add_argument("--graph_opt_level",
+            type = int,
+            default = 1,
+            help = "1 to run the graph optimizations (constant folding, cse), 0 to disable them"
+        )
+    argparser.add_argument("--auto_threads",
+            type = int,
+            default = 0,
+            help = "benchmark thread configurations on a synthetic batch and use the fastest"
+        )
+    argparser.add_argument("--num_workers",
+            type = int,
+            default = 1,
+            help = "synchronous data-parallel training over this many worker processes"
+        )
+    argparser.add_argument("--worker_rank",
+            type = int,
+            default = -1,
+            help = "rank of this worker, set by the launcher; -1 starts all --num_workers workers locally"
+        )
+    argparser.add_argument("--coordinator",
+            type = str,
+            default = "",
+            help = "host:port of the gradient allreduce, served by the rank 0 worker; the launcher picks a free local port if empty"
+        )
+    argparser.add_argument("--inference",
+            type = int,
+            default = 0,
+            help = "restore --load_model and only evaluate/dump the rationales, with a deterministic z"
+        )
+    argparser.add_argument("--infer_threshold",
+            type = float,
+            default = 0.5,
+            help = "a word is selected at inference when its probability is at least this"
+        )
     argparser.add_argument("--train",
             type = str,
             default = "data/reviews.aspect1.train.txt.gz",
             help = "path to training data"
         )
+    argparser.add_argument("--compile_data",
+            type = int,
+            default = 0,
+            help = "compile the train and dev files once into memory-mapped token ids"
+        )
     argparser.add_argument("--dev",
             type = str,
             default = "data/reviews.aspect1.heldout.txt.gz",
@@ -76,6 +171,21 @@ def load_arguments():
             default = 0.0005,# was set to 0.0005
             help = "learning rate"
         )
+    argparser.add_argument("--generator_lr_scale",
+            type = float,
+            default = 1.0,
+            help = "learning rate of the generator relative to --learning_rate"
+        )
+    argparser.add_argument("--joint_updates",
+            type = int,
+            default = 0,
+            help = "compute the encoder and generator gradients in a single backward pass"
+        )
+    argparser.add_argument("--accumulate_steps",
+            type = int,
+            default = 1,
+            help = "sum the gradients of this many batches before one update (effective batch = batch x accumulate_steps)"
+        )
     argparser.add_argument("--dropout",
             type = float,
             default = 0.1,
@@ -159,6 +269,46 @@ def load_arguments():
             type = int,
             default = 1
         )
+    argparser.add_argument("--resident_emb",
+            type = int,
+            default = 1,
+            help = "keep the embedding matrix in the graph instead of feeding it every step"
+        )
+    argparser.add_argument("--precompute_inputs",
+            type = int,
+            default = 0,
+            help = "compute the input projections of the RCNN layers for the whole sequence before the scans"
+        )
+    argparser.add_argument("--fused_cell",
+            type = int,
+            default = 0,
+            help = "pack the RCNN filter and gate weights into one input and one recurrent matrix"
+        )
+    argparser.add_argument("--bidirectional_scan",
+            type = int,
+            default = 0,
+            help = "run the forward and backward generator layers in one scan"
+        )
+    argparser.add_argument("--single_pass_z",
+            type = int,
+            default = 0,
+            help = "take the z logits from the sampling scan instead of a second pass of the Z layer"
+        )
+    argparser.add_argument("--num_samples",
+            type = int,
+            default = 1,
+            help = "z samples per document while training, the other samples are the baseline of each"
+        )
+    argparser.add_argument("--compact_encoder",
+            type = int,
+            default = 0,
+            help = "run the encoder over the selected words only instead of the masked full documents"
+        )
+    argparser.add_argument("--hidden_scan",
+            type = int,
+            default = 0,
+            help = "the RCNN scans only stack h per step instead of the full (order+1)*n_d state"
+        )
     # added argument for initializer
     argparser.add_argument("--initialization",
             type = str,
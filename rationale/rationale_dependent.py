@@ -6,10 +6,29 @@ rationale_dependent.py
 """
 from options import load_arguments
 from IO import create_embedding_layer, read_annotations, create_batches, read_rationales
+from IO import create_pruned_embedding_layer, embedding_store_base, load_compiled_annotations
 import tensorflow as tf
+import os
+import sys
 import numpy as np
 
 from models import Model
+from session_config import configure_session
+from distributed import AllreduceServer, AllreduceClient, launch_workers
+
+def load_annotations(path, embed_layer, text = None):
+    '''
+    Token ids, truncated to max_len, and labels of an annotations file. 
+    Either memory-mapped from the compiled format or mapped from the text.
+    '''
+    if args.compile_data:
+        x, y = load_compiled_annotations(path, embed_layer, args.workers)
+        return x.truncate(args.max_len), y
+    
+    x, y = text if text is not None else read_annotations(path, args.workers)
+    x = embed_layer.map_corpus_to_ids(x).truncate(args.max_len)
+    return x, y
+    
 def main():
     print 'Parser Arguments' 
     for key, value in args.__dict__.iteritems():
@@ -18,43 +37,130 @@ def main():
     # ensure embeddings exist
     assert args.embedding, "Pre-trained word embeddings required."
     
-    embed_layer = create_embedding_layer(
-                                         args.embedding
-                                         )
+    allreduce, server = None, None
+    if args.num_workers > 1 and args.train and not args.inference:
+        assert args.coordinator, "--worker_rank needs --coordinator"
+        
+        # the chief serves the allreduce for all workers
+        if args.worker_rank == 0:
+            server = AllreduceServer(args.coordinator, args.num_workers)
+        allreduce = AllreduceClient(args.coordinator, args.worker_rank,
+                                    args.num_workers)
+        
+        # the chief builds the stores, indexes and compiled data, the other
+        # workers only load them
+        if args.worker_rank > 0:
+            allreduce.barrier()
     
-    max_len = args.max_len
+    if args.load_rationale:
+        rationale_data = read_rationales(args.load_rationale, args.workers)
     
-    if args.train:
-        train_x, train_y = read_annotations(args.train)
-        train_x = [ embed_layer.map_to_ids(x)[:max_len] for x in train_x ]
+    train_text, dev_text = None, None
+    if args.prune_vocab:
+        # collect the words used by the corpora before loading the embeddings
+        corpus_words = set()
+        if args.train:
+            train_text = read_annotations(args.train, args.workers)
+            for x in train_text[0]: corpus_words.update(x)
+        if args.dev:
+            dev_text = read_annotations(args.dev, args.workers)
+            for x in dev_text[0]: corpus_words.update(x)
+        if args.load_rationale:
+            # json gives unicode, the annotations utf-8 str
+            for x in rationale_data: 
+                corpus_words.update(w.encode("utf-8") if isinstance(w, unicode) 
+                                    else w for w in x["x"])
+        
+        # pruned store is written next to the data
+        data_dir = os.path.dirname(args.train or args.dev or args.load_rationale)
+        pruned_path = os.path.join(data_dir, 
+                os.path.basename(embedding_store_base(args.embedding)) + ".pruned")
+        
+        embed_layer = create_pruned_embedding_layer(
+                                         args.embedding,
+                                         corpus_words,
+                                         pruned_path,
+                                         use_store = args.embedding_store,
+                                         store_dtype = args.embedding_dtype,
+                                         workers = args.workers
+                                         )
+    else:
+        embed_layer = create_embedding_layer(
+                                         args.embedding,
+                                         use_store = args.embedding_store,
+                                         store_dtype = args.embedding_dtype,
+                                         workers = args.workers
+                                         )
+    
+    # an inference run only needs the rationale data
+    if args.train and not args.inference:
+        train_x, train_y = load_annotations(args.train, embed_layer, train_text)
                    
-    if args.dev:      
-        dev_x, dev_y = read_annotations(args.dev)
-        dev_x = [ embed_layer.map_to_ids(x)[:max_len] for x in dev_x ]
+    if args.dev and not args.inference:      
+        dev_x, dev_y = load_annotations(args.dev, embed_layer, dev_text)
     
     if args.load_rationale:
-        rationale_data = read_rationales(args.load_rationale)
-        for x in rationale_data:
-            x["xids"] = embed_layer.map_to_ids(x["x"])
+        rationale_ids = embed_layer.map_corpus_to_ids([ x["x"] for x in rationale_data ])
+        for x, xids in zip(rationale_data, rationale_ids):
+            x["xids"] = xids
+    
+    if allreduce is not None and args.worker_rank == 0:
+        allreduce.barrier()
             
 
-    if args.train:
+    if args.inference:
+        assert args.load_model, "--inference needs --load_model"
+        assert args.load_rationale, "--inference needs --load_rationale"
+        nclasses = len(rationale_data[0]["y"])
+    elif args.train:
+        nclasses = len(train_y[0])
+    
+    def benchmark_step(sess):
+        model = Model(args = args, embedding_layer = embed_layer,
+                      nclasses = nclasses, inference = args.inference)
+        model.ready()
+        return model.synthetic_step(sess)
+    
+    if args.inference or args.train:
+        config = configure_session(args, benchmark_step)
+
+    if args.inference:
         with tf.Graph().as_default() as g:
             
-            # used to be set to 2345
             tf.set_random_seed(2345)
+            
+            with tf.Session(config = config) as sess:
+                
+                model = Model(
+                            args = args,
+                            embedding_layer = embed_layer,
+                            nclasses = nclasses,
+                            inference = True
+                        )
+                model.ready()
+                model.restore(sess, args.load_model)
+                model.run_inference(rationale_data, sess)
+    
+    elif args.train:
+        with tf.Graph().as_default() as g:
+            
+            # used to be set to 2345
+            # (per worker, so the workers sample different rationales)
+            tf.set_random_seed(2345 + max(args.worker_rank, 0))
             np.random.seed(2345)
             
-            with tf.Session() as sess:
+            with tf.Session(config = config) as sess:
                 # initialize Model
                 
                 model = Model(
                             args = args,
                             embedding_layer = embed_layer,
-                            nclasses = len(train_y[0])
+                            nclasses = nclasses
                         )
                 model.ready()
                 
+                if allreduce is not None:
+                    model.set_distributed(allreduce)
                 
                 # added this for testing
                 model.train((train_x, train_y),
@@ -62,6 +168,11 @@ def main():
                             None,
                             rationale_data if args.load_rationale else None,
                             sess) 
+        
+        if allreduce is not None:
+            allreduce.close()
+        if server is not None:
+            server.join()
 
 
 def reset_graph():
@@ -73,6 +184,11 @@ def reset_graph():
 if __name__ == '__main__':
     args = load_arguments()
     
+    # data-parallel training, start the workers and wait for them
+    if args.num_workers > 1 and args.worker_rank < 0 and not args.inference:
+        sys.exit(launch_workers(sys.argv, args.num_workers, 
+                                args.intra_op_threads, args.coordinator))
+    
     # reset zie graph
     reset_graph()
     
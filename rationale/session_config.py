@@ -0,0 +1,168 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+session_config.py
+CPU threading and graph options of the tf.Session.
+
+Methods:
+parse_cpu_list:
+    - parses a cpu list like "0-7,16,18"
+set_cpu_affinity:
+    - pins the process to a set of cpus
+make_session_config:
+    - ConfigProto with the thread pools and graph optimizer level
+benchmark_configs:
+    - times a step under several thread configurations
+configure_session:
+    - applies the command line options, benchmarks with --auto_threads, and
+      prints the chosen configuration to the run log
+"""
+
+import os
+import time
+import subprocess
+import multiprocessing
+import tensorflow as tf
+
+
+def parse_cpu_list(spec):
+    '''
+    "0-3,8" --> [0, 1, 2, 3, 8]
+    '''
+    cpus = [ ]
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-")
+            cpus.extend(range(int(a), int(b) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+
+def set_cpu_affinity(spec):
+    '''
+    Pin this process, and the threads it starts later, to the cpus of spec.
+    Python 2 has no sched_setaffinity, taskset is used instead.
+    Returns whether it succeeded.
+    '''
+    cpus = parse_cpu_list(spec)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        return True
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["taskset", "-a", "-p", "-c",
+                                   ",".join(map(str, cpus)), str(os.getpid())],
+                                  stdout = devnull)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        print 'Could not set the cpu affinity to {}, taskset failed.'.format(spec)
+        return False
+
+
+def available_cpus(affinity = ""):
+    '''
+    Number of cpus the process may run on.
+    '''
+    if affinity:
+        return len(parse_cpu_list(affinity))
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def make_session_config(intra_op_threads = 0, inter_op_threads = 0,
+                        opt_level = 1):
+    '''
+    intra_op_threads: threads used inside one op (e.g. a matmul), 0 for the
+                      TF default (all cores)
+    inter_op_threads: ops run concurrently, 0 for the TF default
+    opt_level       : 1 for the graph optimizations (constant folding,
+                      common subexpression elimination), 0 to disable them
+    The inter op pool is per session: by default it belongs to the process
+    and is fixed by its first session, e.g. the first benchmark candidate.
+    '''
+    level = tf.OptimizerOptions.L1 if opt_level else tf.OptimizerOptions.L0
+    graph_options = tf.GraphOptions(
+                        optimizer_options = tf.OptimizerOptions(opt_level = level))
+
+    return tf.ConfigProto(intra_op_parallelism_threads = intra_op_threads,
+                          inter_op_parallelism_threads = inter_op_threads,
+                          use_per_session_threads = True,
+                          graph_options = graph_options)
+
+
+def thread_candidates(n_cpus):
+    '''
+    (intra, inter) pairs tried by --auto_threads.
+    '''
+    pairs = [ (n_cpus, 1), (n_cpus, 2), (n_cpus // 2, 2), (n_cpus // 2, 4),
+              (n_cpus // 4, 4), (n_cpus // 4, 8) ]
+
+    candidates = [ ]
+    for intra, inter in pairs:
+        pair = (max(intra, 1), inter)
+        if pair not in candidates:
+            candidates.append(pair)
+    return candidates
+
+
+def benchmark_configs(candidates, build, opt_level = 1, steps = 5, warmup = 2):
+    '''
+    Time a step under every (intra, inter) candidate.
+    build(sess) is called in a fresh graph and returns (fetches, feed_dict)
+    of the step, e.g. a forward and backward pass on a synthetic batch.
+    Returns (seconds per step, intra, inter) sorted fastest first.
+    '''
+    results = [ ]
+    for intra, inter in candidates:
+        config = make_session_config(intra, inter, opt_level)
+        with tf.Graph().as_default():
+            tf.set_random_seed(2345)
+            with tf.Session(config = config) as sess:
+                fetches, feed_dict = build(sess)
+
+                for _ in xrange(warmup):
+                    sess.run(fetches, feed_dict = feed_dict)
+
+                start = time.time()
+                for _ in xrange(steps):
+                    sess.run(fetches, feed_dict = feed_dict)
+                elapsed = (time.time() - start) / steps
+
+        print '\tintra_op={} inter_op={}: {:.3f}s/step'.format(intra, inter,
+                                                            elapsed)
+        results.append((elapsed, intra, inter))
+
+    return sorted(results)
+
+
+def configure_session(args, build = None):
+    '''
+    Session config from the command line options. With --auto_threads the
+    thread counts are chosen by benchmarking build (see benchmark_configs).
+    '''
+    if args.cpu_affinity:
+        set_cpu_affinity(args.cpu_affinity)
+
+    intra, inter = args.intra_op_threads, args.inter_op_threads
+
+    if args.auto_threads and build is not None:
+        n_cpus = available_cpus(args.cpu_affinity)
+        print 'Benchmarking thread configurations on {} cpus'.format(n_cpus)
+        results = benchmark_configs(thread_candidates(n_cpus), build,
+                                    opt_level = args.graph_opt_level)
+        _, intra, inter = results[0]
+
+    print ('Session config: intra_op_threads={} inter_op_threads={} ' +
+           'cpu_affinity={} graph_opt_level={}').format(
+                intra or 'default',
+                inter or 'default',
+                args.cpu_affinity or 'none',
+                args.graph_opt_level)
+
+    return make_session_config(intra, inter, args.graph_opt_level)